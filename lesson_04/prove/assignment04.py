@@ -15,11 +15,16 @@ where:
 name: name of the city
 recno: record number starting from 0
 
+or many records at once with f'{TOP_API_URL}/records/{name}/{start}/{count}'
+
+or the stats of a city's first count records with f'{TOP_API_URL}/stats/{name}?n={count}'
+
 """
 
 import time
 import threading
 import queue
+import json
 import requests
 from common import *
 
@@ -30,72 +35,257 @@ WORKERS = 10
 RECORDS_TO_RETRIEVE = 5000
 COMMAND_BATCH = 1000
 
+# Records asked for in one /records request (0 = one /record request each)
+RECORDS_PER_REQUEST = 500
+
+# Get each city's stats with one /stats request instead of retrieving the
+# records (False = retrieve the records, which checks the server's numbers)
+USE_STATS_ENDPOINT = False
+
+# Replies waiting for the Workers, and most replies a Worker takes at a time
+DATA_QUEUE_SIZE = 1000
+WORKER_BATCH = 100
+
 
 # ---------------------------------------------------------------------------
-def retrieve_weather_data(cmd_q, data_q, noaa):
+def add_weather_data(noaa, city, data):
+    """ data is the reply from /record or /records (bytes, or already decoded
+        when it came from get_data_from_server()) """
+    try:
+        item = json.loads(data) if isinstance(data, bytes) else data
+    except ValueError:
+        return
+    if item and 'temps' in item:
+        noaa.add_temps(city, item['temps'])
+    elif item and 'temp' in item:
+        noaa.add_temp(city, item['temp'])
+
+
+# ---------------------------------------------------------------------------
+def retrieve_weather_data(cmd_q, data_q, noaa, stats=None):
+    # Only gets the replies, they are put on data_q as raw bytes for the
+    # Workers (or added to noaa here when there is no data_q)
     session = requests.Session()
+    busy = 0.0
+    blocked = 0.0
 
-    while True:
+    done = False
+    while not done:
         commands = []
         try:
             for _ in range(COMMAND_BATCH):
                 cmd = cmd_q.get_nowait()
                 if cmd is None:
-                    return
+                    done = True
+                    break
                 commands.append(cmd)
         except:
             pass
 
-        if not commands:
+        if not commands and not done:
             try:
                 cmd = cmd_q.get(timeout=1)
                 if cmd is None:
-                    return
+                    break
                 commands.append(cmd)
             except:
                 continue
 
-        for city, recno in commands:
-            url = f"{TOP_API_URL}/record/{city}/{recno}"
+        for cmd in commands:
+            start_time = time.perf_counter()
+            # (city, start, count) is a range of records
+            if len(cmd) == 3:
+                city, start, count = cmd
+                url = f"{TOP_API_URL}/records/{city}/{start}/{count}"
+            else:
+                city, recno = cmd
+                url = f"{TOP_API_URL}/record/{city}/{recno}"
             try:
                 resp = session.get(url, timeout=10)
                 resp.raise_for_status()
-                item = resp.json()
-                if item and 'temp' in item:
-                    with noaa.city_locks[city]:
-                        noaa.temps[city].append(item['temp'])
+                data = resp.content
             except:
-                response = get_data_from_server(url)
-                if response and 'temp' in response:
-                    with noaa.city_locks[city]:
-                        noaa.temps[city].append(response['temp'])
+                data = get_data_from_server(url)
+            busy += time.perf_counter() - start_time
+
+            if data_q is None:
+                add_weather_data(noaa, city, data)
+            elif data is not None:
+                start_time = time.perf_counter()
+                data_q.put((city, data))
+                blocked += time.perf_counter() - start_time
+
+    if stats is not None:
+        stats.add_time('retriever', busy, blocked)
 
 
 # ---------------------------------------------------------------------------
 class Worker(threading.Thread):
+    """ Takes up to WORKER_BATCH replies at a time from data_q, decodes them
+        and adds the temps to noaa.  Stops at None. """
 
-    def __init__(self, noaa):
+    def __init__(self, noaa, data_q, stats=None):
         threading.Thread.__init__(self)
         self.noaa = noaa
+        self.data_q = data_q
+        self.stats = stats
 
     def run(self):
-        pass
+        busy = 0.0
+        done = False
+        while not done:
+            batch = [self.data_q.get()]
+            if self.stats is not None:
+                self.stats.sample_depth(self.data_q.qsize())
+            try:
+                # one None for each Worker, don't take another Worker's
+                while batch[-1] is not None and len(batch) < WORKER_BATCH:
+                    batch.append(self.data_q.get_nowait())
+            except queue.Empty:
+                pass
+
+            start_time = time.perf_counter()
+            for item in batch:
+                if item is None:
+                    done = True
+                else:
+                    add_weather_data(self.noaa, *item)
+            busy += time.perf_counter() - start_time
+
+        if self.stats is not None:
+            self.stats.add_time('worker', busy)
+
+
+# ---------------------------------------------------------------------------
+class PipelineStats:
+    """ How busy each stage was and how full data_q got, to size THREADS,
+        WORKERS and DATA_QUEUE_SIZE """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.busy = {'retriever': 0.0, 'worker': 0.0}
+        self.blocked = {'retriever': 0.0}
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+
+    def add_time(self, stage, busy, blocked=0.0):
+        """ Called once by every thread when it is done """
+        with self.lock:
+            self.busy[stage] += busy
+            if blocked:
+                self.blocked[stage] += blocked
+
+    def sample_depth(self, depth):
+        with self.lock:
+            self.depth_total += depth
+            self.depth_samples += 1
+            self.depth_max = max(self.depth_max, depth)
+
+    def report(self, threads, workers):
+        wall = time.perf_counter() - self.start_time
+        average = self.depth_total / self.depth_samples if self.depth_samples else 0
+        print()
+        print('Pipeline')
+        print('===================================')
+        print(f'data_q depth average / max  : {average:.1f} / {self.depth_max} (size {DATA_QUEUE_SIZE})')
+        busy = self.busy['retriever'] / (threads * wall) * 100
+        blocked = self.blocked['retriever'] / (threads * wall) * 100
+        print(f'retrievers ({threads:>4})    : {busy:5.1f}% busy, {blocked:5.1f}% waiting for room on data_q')
+        busy = self.busy['worker'] / (workers * wall) * 100
+        print(f'   workers ({workers:>4})    : {busy:5.1f}% busy')
+        print('===================================')
+
+
+# ---------------------------------------------------------------------------
+class RunningStats:
+    """ Count, sum and Welford mean/M2 of the temps added, without keeping
+        the temps.  merge() combines two of them (Chan et al.).  The mean is
+        total / count so it is exactly what sum(temps) / len(temps) gives. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.running_mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.running_mean
+        self.running_mean += delta / self.count
+        self.m2 += delta * (value - self.running_mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.running_mean - self.running_mean
+        self.running_mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+
+    def get_mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def get_variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+
+def stats_from_reply(reply):
+    """ RunningStats with the count, sum, mean and variance of a /stats reply """
+    stats = RunningStats()
+    stats.count = reply['count']
+    stats.total = reply['sum']
+    stats.running_mean = reply['mean']
+    stats.m2 = reply['variance'] * reply['count']
+    return stats
 
 
 # ---------------------------------------------------------------------------
 class NOAA:
+    """ Every thread adds temps to its own RunningStats for each city (no
+        locks), they are merged when the results are read """
 
     def __init__(self):
-        self.temps = {city: [] for city in CITIES}
-        self.city_locks = {city: threading.Lock() for city in CITIES}
+        self.local = threading.local()
+        self.partials = []
         self.read_lock = threading.Lock()
 
-    def get_temp_details(self, city):
+    def _get_partial(self):
+        partial = getattr(self.local, 'stats', None)
+        if partial is None:
+            partial = {city: RunningStats() for city in CITIES}
+            self.local.stats = partial
+            with self.read_lock:
+                self.partials.append(partial)
+        return partial
+
+    def add_temp(self, city, temp):
+        self._get_partial()[city].add(temp)
+
+    def add_temps(self, city, temps):
+        stats = self._get_partial()[city]
+        for temp in temps:
+            stats.add(temp)
+
+    def add_stats(self, city, stats):
+        """ Adds temps that were already summed up in a RunningStats """
+        self._get_partial()[city].merge(stats)
+
+    def get_temp_stats(self, city):
+        """ RunningStats for the city from all threads (call after the
+            threads are done) """
+        stats = RunningStats()
         with self.read_lock:
-            values = self.temps[city]
-            if values:
-                return sum(values) / len(values)
-        return 0.0
+            for partial in self.partials:
+                stats.merge(partial[city])
+        return stats
+
+    def get_temp_details(self, city):
+        return self.get_temp_stats(city).get_mean()
 
 
 # ---------------------------------------------------------------------------
@@ -130,44 +320,41 @@ def verify_noaa_results(noaa):
 
 
 # ---------------------------------------------------------------------------
-def main():
-
-    log = Log(show_terminal=True, filename_log='assignment.log')
-    log.start_timer()
-
-    noaa = NOAA()
-
-    data = get_data_from_server(f'{TOP_API_URL}/start')
-
-    print('Retrieving city details')
-    city_details = {}
-    name = 'City'
-    print(f'{name:>15}: Records')
-    print('===================================')
-    for name in CITIES:
-        city_details[name] = get_data_from_server(f'{TOP_API_URL}/city/{name}')
-        print(f'{name:>15}: Records = {city_details[name]['records']:,}')
-    print('===================================')
+def retrieve_city_stats(noaa, records):
+    """ One /stats request for each city """
+    for city in CITIES:
+        reply = get_data_from_server(f'{TOP_API_URL}/stats/{city}?n={records}')
+        if reply is not None:
+            noaa.add_stats(city, stats_from_reply(reply))
 
-    records = RECORDS_TO_RETRIEVE
 
+# ---------------------------------------------------------------------------
+def retrieve_records(noaa, records):
+    """ Retrieves the records with THREADS retrievers and WORKERS Workers,
+        returns the PipelineStats """
     cmd_q = queue.Queue(maxsize=10)
+    data_q = queue.Queue(maxsize=DATA_QUEUE_SIZE)
+    stats = PipelineStats()
 
     retrievers = []
     for _ in range(THREADS):
-        t = threading.Thread(target=retrieve_weather_data, args=(cmd_q, None, noaa))
+        t = threading.Thread(target=retrieve_weather_data, args=(cmd_q, data_q, noaa, stats))
         t.start()
         retrievers.append(t)
 
     workers = []
     for _ in range(WORKERS):
-        w = Worker(noaa)
+        w = Worker(noaa, data_q, stats)
         w.start()
         workers.append(w)
 
     for city in CITIES:
-        for rec in range(records):
-            cmd_q.put((city, rec))
+        if RECORDS_PER_REQUEST:
+            for start in range(0, records, RECORDS_PER_REQUEST):
+                cmd_q.put((city, start, min(RECORDS_PER_REQUEST, records - start)))
+        else:
+            for rec in range(records):
+                cmd_q.put((city, rec))
 
     for _ in range(THREADS):
         cmd_q.put(None)
@@ -175,12 +362,47 @@ def main():
     for t in retrievers:
         t.join()
 
+    for _ in range(WORKERS):
+        data_q.put(None)
+
     for w in workers:
         w.join()
 
+    return stats
+
+
+# ---------------------------------------------------------------------------
+def main():
+
+    log = Log(show_terminal=True, filename_log='assignment.log')
+    log.start_timer()
+
+    noaa = NOAA()
+
+    data = get_data_from_server(f'{TOP_API_URL}/start')
+
+    print('Retrieving city details')
+    city_details = {}
+    name = 'City'
+    print(f'{name:>15}: Records')
+    print('===================================')
+    for name in CITIES:
+        city_details[name] = get_data_from_server(f'{TOP_API_URL}/city/{name}')
+        print(f'{name:>15}: Records = {city_details[name]['records']:,}')
+    print('===================================')
+
+    if USE_STATS_ENDPOINT:
+        retrieve_city_stats(noaa, RECORDS_TO_RETRIEVE)
+        stats = None
+    else:
+        stats = retrieve_records(noaa, RECORDS_TO_RETRIEVE)
+
     data = get_data_from_server(f'{TOP_API_URL}/end')
     print(data)
 
+    if stats is not None:
+        stats.report(THREADS, WORKERS)
+
     verify_noaa_results(noaa)
 
     log.stop_timer('Run time: ')
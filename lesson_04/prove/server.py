@@ -27,6 +27,17 @@ API
 /end
 /city/{city}
 /record/{city}/{recno}`
+/records/{city}/{start}/{count}     {"dates": [...], "temps": [...]} for up to
+                                    MAX_RECORDS records from start
+/stats/{city}?n={count}             count, sum, mean, min, max and variance of
+                                    the first n temps (default all)
+
+Options
+
+--quiet         don't echo every request and reply to the terminal
+--log-flush S   seconds between flushes of server.log
+--convert       write the binary data/*.col files and stop (/start also
+                makes them when they are missing or out of date)
 
 """
 
@@ -37,7 +48,17 @@ import json
 import time
 import random
 import threading
+import queue
+import atexit
 import ast
+import argparse
+import mmap
+import os
+import struct
+import sys
+import urllib.parse
+from array import array
+import numpy as np
 
 # Consts
 hostName = "127.0.0.1"
@@ -46,8 +67,18 @@ serverPort = 8123
 SLEEP = 0.1
 MAX_GENERATIONS = 6
 
+# Log file writer: seconds between flushes and most lines written at a time
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH = 1000
+
+# Don't echo every request and reply to the terminal (--quiet)
+QUIET = False
+
 DATA_FOLDER = 'data/'
 
+# Most records returned by one /records request
+MAX_RECORDS = 10000
+
 # Global Variables
 max_thread_count = 0
 call_count = 0
@@ -68,36 +99,187 @@ CITIES = (
     ('phoenix' , 'phoenix.dat'),
 )
 
-# key = 'city name', value [[date, temp], ...]
+# key = 'city name', value CityColumns
 cities_data = {}
 
+# key = (city name, n), value /stats reply
+city_stats = {}
+
 start_time = time.time()
 end_time = time.time()
 
 # ----------------------------------------------------------------------------
-class Log:
+# Binary city files
+#
+# data/{city}.col is made from data/{city}.dat the first time it is needed:
+#
+#   header  16 bytes  b'NOAA', version, byte order (1 = little), record count
+#   dates   4 bytes a record, month << 22 | day << 17 | hour << 12 | minute << 6 | second
+#   temps   4 bytes a record, float32
+#
+# The file is mmap'd and the columns are memoryviews on it, so a record is
+# read straight from the page cache without building Python lists.
+
+COLUMN_MAGIC = b'NOAA'
+COLUMN_VERSION = 1
+COLUMN_HEADER = struct.Struct('=4sIII')
+
+
+def pack_date(date_str):
+    """ "mmdd hhmmss" -> 32 bit number """
+    return (int(date_str[:2]) << 22 | int(date_str[2:4]) << 17 | int(date_str[5:7]) << 12 |
+            int(date_str[7:9]) << 6 | int(date_str[9:11]))
+
+
+def unpack_date(packed):
+    """ 32 bit number -> "mm-dd hh:mm:ss" """
+    return (f'{packed >> 22:02}-{packed >> 17 & 0x1f:02} '
+            f'{packed >> 12 & 0x1f:02}:{packed >> 6 & 0x3f:02}:{packed & 0x3f:02}')
+
+
+def convert_city_file(dat_filename, col_filename):
+    """ Write the .dat (JSON) file as a binary .col file """
+    with open(dat_filename, 'r') as f:
+        records = json.load(f)
+    dates = array('I', (pack_date(date_str) for date_str, _ in records))
+    temps = array('f', (temp for _, temp in records))
+    byte_order = 1 if sys.byteorder == 'little' else 0
+    # write then rename, a server reading the old file is not disturbed
+    with open(col_filename + '.tmp', 'wb') as f:
+        f.write(COLUMN_HEADER.pack(COLUMN_MAGIC, COLUMN_VERSION, byte_order, len(records)))
+        dates.tofile(f)
+        temps.tofile(f)
+    os.replace(col_filename + '.tmp', col_filename)
+
+
+def json_number(value):
+    """ Whole number temps are sent as ints, like the .dat files have them """
+    return int(value) if value.is_integer() else value
+
+
+class CityColumns:
+    """ Read only view of a .col file """
 
     def __init__(self, filename):
         super().__init__()
-        self.lock = threading.Lock()
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, count = COLUMN_HEADER.unpack_from(self.data)
+        if magic != COLUMN_MAGIC or version != COLUMN_VERSION or byte_order != (sys.byteorder == 'little'):
+            raise ValueError(f'{filename} is not a version {COLUMN_VERSION} city file for this machine')
+        view = memoryview(self.data)
+        start = COLUMN_HEADER.size
+        self.dates = view[start:start + 4 * count].cast('I')
+        self.temps = view[start + 4 * count:start + 8 * count].cast('f')
+
+    def __len__(self):
+        return len(self.temps)
+
+    def record(self, recno):
+        """ ("mm-dd hh:mm:ss", temp) """
+        if recno < 0:
+            raise IndexError(recno)
+        return unpack_date(self.dates[recno]), json_number(self.temps[recno])
+
+    def records(self, start, count):
+        """ ([dates], [temps]) for up to count records from start """
+        dates = self.dates[start:start + count]
+        temps = self.temps[start:start + count]
+        return [unpack_date(packed) for packed in dates], [json_number(temp) for temp in temps]
+
+
+def load_city(filename):
+    """ CityColumns for a city, (re)making the .col file when it is missing,
+        older than the .dat file or from another version or machine """
+    dat_filename = DATA_FOLDER + filename
+    col_filename = os.path.splitext(dat_filename)[0] + '.col'
+    if not os.path.exists(col_filename) or os.path.getmtime(col_filename) < os.path.getmtime(dat_filename):
+        convert_city_file(dat_filename, col_filename)
+    try:
+        return CityColumns(col_filename)
+    except ValueError:
+        convert_city_file(dat_filename, col_filename)
+        return CityColumns(col_filename)
+
+# ----------------------------------------------------------------------------
+def get_city_stats(name, n):
+    """ /stats reply for the first n records of a city, made once for each
+        (city, n) after a /start """
+    key = (name, n)
+    if key not in city_stats:
+        if n <= 0:
+            raise ValueError(n)
+        temps = np.frombuffer(cities_data[name].temps, dtype=np.float32)[:n].astype(np.float64)
+        total = float(temps.sum())
+        # sum / count, the same mean the client gets by adding up the records
+        city_stats[key] = json.dumps({"status": "OK", "city": name, "count": len(temps),
+                                      "sum": json_number(total), "mean": total / len(temps),
+                                      "min": json_number(float(temps.min())),
+                                      "max": json_number(float(temps.max())),
+                                      "variance": float(temps.var())})
+    return city_stats[key]
+
+# ----------------------------------------------------------------------------
+class Log:
+    """ write() only puts the line on a queue.  A background thread writes the
+        lines to the file in batches and flushes it every flush_interval
+        seconds, so request threads never wait on the disk """
+
+    def __init__(self, filename, flush_interval=LOG_FLUSH_INTERVAL):
+        super().__init__()
         self.filename = filename
+        self.flush_interval = flush_interval
         self.file = open(filename, 'w')
+        self.lines = queue.SimpleQueue()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+        self.lines.put(line)
+
+    def _write_lines(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            batch = []
+            try:
+                batch.append(self.lines.get(timeout=self.flush_interval))
+                while len(batch) < LOG_BATCH:
+                    batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                pass
+
+            # None is put on the queue by close()
+            done = None in batch
+            lines = [line for line in batch if line is not None]
+            if lines:
+                self.file.write('\n'.join(lines))
+                self.file.write('\n')
+
+            if done or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
 
-    def __del__(self):
         self.file.close()
 
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.writer.join()
+
 # Global log object
 log = Log('server.log')
 
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    def log_message(self, format, *args):
+        if not QUIET:
+            super().log_message(format, *args)
+
     def get_city_details(self, name):
         # global people
         # if id in people:
@@ -128,11 +310,14 @@ class Handler(BaseHTTPRequestHandler):
             call_count += 1
             if thread_count > max_thread_count:
                 max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+            if not QUIET:
+                print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
             log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(s := f'Request: {self.path}')
+        s = f'Request: {self.path}'
+        if not QUIET:
+            print('- ' * 35)
+            print(s)
         log.write(s)
 
         # START ---------------------------------------------------
@@ -142,11 +327,11 @@ class Handler(BaseHTTPRequestHandler):
 
             # Load DAT files
             cities_data = {}
+            city_stats.clear()
             for name, filename in CITIES:
                 print(s := f'Loading city data {name}')
                 log.write(s)
-                with open(DATA_FOLDER + filename, 'r') as f:
-                    cities_data[name] = json.load(f)
+                cities_data[name] = load_city(filename)
 
             max_thread_count = 1
             thread_count = 1
@@ -186,6 +371,30 @@ class Handler(BaseHTTPRequestHandler):
             print('#' * 80)
             log.write('#' * 80)
 
+        # CITY STATISTICS  ------------------------------------------------
+        elif self.path.startswith('/stats/'):
+
+            # one wait for the whole city
+            if SLEEP > 0:
+                time.sleep(SLEEP)
+
+            url = urllib.parse.urlsplit(self.path)
+            parts = url.path.split('/')
+            try:
+                if len(parts) != 3:
+                    raise ValueError
+                name = parts[-1].lower()
+                n = urllib.parse.parse_qs(url.query).get('n')
+                n = int(n[0]) if n else len(cities_data[name])
+                json_data = get_city_stats(name, n)
+            except (ValueError, KeyError):
+                self.send_response(404)
+                self.send_header("Content-type",  "application/json")
+                self.end_headers()
+                with lock:
+                    thread_count -= 1
+                return
+
         # CITY DETAILS  ---------------------------------------------------
         elif 'city' in self.path:
             parts = self.path.split('/')
@@ -226,6 +435,36 @@ class Handler(BaseHTTPRequestHandler):
                        '}'
             json_data = json.dumps(ast.literal_eval(data_str))
 
+        # CITY RECORD RANGE  ---------------------------------------------
+        elif 'records' in self.path:
+
+            # one wait for the whole range
+            if SLEEP > 0:
+                time.sleep(SLEEP)
+
+            parts = self.path.split('/')
+
+            try:
+                if len(parts) != 5:
+                    raise ValueError
+                name = parts[-3].lower()
+                start = int(parts[-2])
+                count = min(int(parts[-1]), MAX_RECORDS)
+                if name not in cities_data or start < 0 or count < 0:
+                    raise ValueError
+            except ValueError:
+                self.send_response(404)
+                self.send_header("Content-type",  "application/json")
+                self.end_headers()
+                with lock:
+                    thread_count -= 1
+                return
+
+            # fewer records past the end
+            dates, temps = cities_data[name].records(start, count)
+            json_data = json.dumps({"status": "OK", "city": name, "start": start,
+                                    "dates": dates, "temps": temps}, separators=(',', ':'))
+
         # CITY RECORD  ---------------------------------------------------
         elif 'record' in self.path:
 
@@ -259,7 +498,9 @@ class Handler(BaseHTTPRequestHandler):
                     thread_count -= 1
                 return
 
-            if name not in cities_data:
+            try:
+                date_str, temp = cities_data[name].record(record)     # "mm-dd hh:mm:ss"
+            except (KeyError, IndexError):
                 self.send_response(404)
                 self.send_header("Content-type",  "application/json")
                 self.end_headers()
@@ -267,18 +508,7 @@ class Handler(BaseHTTPRequestHandler):
                     thread_count -= 1
                 return
 
-            date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
-            temp = cities_data[name][record][1]
-
-            # Expand date string to "mm-dd hh:mm:ss"
-            #         01234567890
-            # format "mmdd hhmmss"
-            date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
-
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+            json_data = json.dumps({"status": "OK", "city": name, "date": date_str, "temp": temp})
 
         else:
             json_data = None
@@ -289,7 +519,8 @@ class Handler(BaseHTTPRequestHandler):
             self.send_header("Content-type",  "application/json")
             self.end_headers()
         else:
-            print('Sending:', json_data)
+            if not QUIET:
+                print('Sending:', json_data)
             log.write(f'Sending: {json_data}')
 
             self.send_response(200)
@@ -306,6 +537,27 @@ class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NOAA weather server')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't echo every request and reply to the terminal")
+    parser.add_argument('--log-flush', type=float, default=LOG_FLUSH_INTERVAL, metavar='SECONDS',
+                        help='seconds between flushes of server.log')
+    parser.add_argument('--convert', action='store_true',
+                        help='write the binary data/*.col files and stop')
+    args = parser.parse_args()
+    if args.log_flush <= 0:
+        # the log thread waits this long for a line, 0 would make it spin
+        parser.error('--log-flush must be more than 0 seconds')
+
+    if args.convert:
+        for name, filename in CITIES:
+            load_city(filename)
+            print(f'Converted {name}')
+        sys.exit(0)
+
+    QUIET = args.quiet
+    log.flush_interval = args.log_flush
+
     server = ThreadingSimpleServer((hostName, serverPort), Handler)
     print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
     server.serve_forever()
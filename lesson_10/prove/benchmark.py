@@ -0,0 +1,205 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: benchmark.py
+Purpose: Assignment 10 - Family Search benchmark
+
+Starts the server in this process on a free port, runs the search functions
+from prove.py for 1 to N generations (each run repeated) and writes one row
+per part and generation count:
+
+    part, title, generations, repeats, p50_seconds, p95_seconds, api_calls,
+    peak_server_threads, rss_mb, requests_per_second, people, families
+
+p50/p95 are over the repeats, the other numbers are from the run with the
+median time except peak_server_threads and rss_mb (largest of the repeats).
+The server shares the process, so rss_mb includes the server's tree.
+
+Examples:
+    python benchmark.py --generations 6 --repeats 3 --csv bench.csv
+    python benchmark.py --parts 4,5,7 --latency lognormal:0.25,0.5 --json bench.json
+    python benchmark.py --async --keep-alive --parts 6,8 --generations 8
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import common
+import functions
+import server
+from common import ConcurrentTree, get_data_from_server, use_concurrency_limiter
+from prove import PARTS
+
+FIELDS = ('part', 'title', 'generations', 'repeats', 'p50_seconds', 'p95_seconds', 'api_calls',
+          'peak_server_threads', 'rss_mb', 'requests_per_second', 'people', 'families')
+
+
+# ----------------------------------------------------------------------------
+def percentile(values, percent):
+    """ Nearest-rank percentile of sorted values """
+    index = max(0, math.ceil(percent / 100 * len(values)) - 1)
+    return values[index]
+
+
+# ----------------------------------------------------------------------------
+def rss_mb():
+    """ Resident memory of this process in MB (peak when the current size
+        can't be read), None when neither is available """
+    try:
+        with open('/proc/self/statm') as statm:
+            return round(int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+
+# ----------------------------------------------------------------------------
+class BenchmarkServer(server.ThreadingSimpleServer):
+    # the default listen backlog (5) drops connections when many crawler
+    # threads connect at once and the client's retry timers end up in the
+    # numbers, use the same backlog as the asyncio server
+    request_queue_size = server.ASYNC_BACKLOG
+
+
+# ----------------------------------------------------------------------------
+def start_server(use_async):
+    """ Serve on a free port in a daemon thread, returns the port """
+    if not use_async:
+        httpd = BenchmarkServer((server.hostName, 0), server.Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd.server_address[1]
+
+    ready = threading.Event()
+    port = None
+
+    async def serve():
+        nonlocal port
+        async_server = await asyncio.start_server(server.handle_async_connection, server.hostName, 0,
+                                                  backlog=server.ASYNC_BACKLOG)
+        port = async_server.sockets[0].getsockname()[1]
+        ready.set()
+        async with async_server:
+            await async_server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    ready.wait()
+    return port
+
+
+# ----------------------------------------------------------------------------
+def run_once(start_id, generations, func):
+    """ Returns (seconds, /end reply, tree, rss) for one search """
+    tree = ConcurrentTree(start_id)
+    get_data_from_server(f'{common.TOP_API_URL}/start/{generations}')
+    start = time.perf_counter()
+    func(start_id, tree)
+    seconds = time.perf_counter() - start
+    server_data = get_data_from_server(f'{common.TOP_API_URL}/end')
+    return seconds, server_data, tree, rss_mb()
+
+
+# ----------------------------------------------------------------------------
+def benchmark(part, generations, repeats, start_id):
+    title, func = PARTS[part]
+    runs = sorted((run_once(start_id, generations, func) for _ in range(repeats)), key=lambda run: run[0])
+    times = [run[0] for run in runs]
+    seconds, server_data, tree, _ = runs[(len(runs) - 1) // 2]
+    rss = [run[3] for run in runs if run[3] is not None]
+    return {
+        'part': part,
+        'title': title,
+        'generations': generations,
+        'repeats': repeats,
+        'p50_seconds': round(percentile(times, 50), 4),
+        'p95_seconds': round(percentile(times, 95), 4),
+        'api_calls': server_data['api'],
+        'peak_server_threads': max(run[1]['threads'] for run in runs),
+        'rss_mb': max(rss) if rss else None,
+        'requests_per_second': round(server_data['api'] / seconds, 1),
+        'people': tree.get_person_count(),
+        'families': tree.get_family_count(),
+    }
+
+
+# ----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Family Search crawler benchmark')
+    parser.add_argument('--parts', default=','.join(str(part) for part in PARTS),
+                        help='part numbers from prove.py, for example 1,4,7 (default all)')
+    parser.add_argument('--generations', type=int, default=6, metavar='N',
+                        help='run 1 to N generations (default 6)')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='runs of each part and generation count (default 3)')
+    parser.add_argument('--csv', metavar='FILE', help='write the rows as CSV')
+    parser.add_argument('--json', metavar='FILE', help='write the rows as JSON')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve requests with asyncio instead of one thread per request')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use HTTP/1.1 persistent connections (and pipelining)')
+    parser.add_argument('--latency', type=server.parse_latency, default=None, metavar='MODEL',
+                        help='server latency model, fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--limiter', action='store_true',
+                        help='use a ConcurrencyLimiter in get_data_from_server()')
+    args = parser.parse_args()
+
+    parts = [int(part) for part in args.parts.split(',')]
+    unknown = [part for part in parts if part not in PARTS]
+    if unknown:
+        parser.error(f'unknown parts: {unknown}')
+
+    server.QUIET = True
+    if args.keep_alive:
+        server.KEEP_ALIVE = True
+        server.Handler.protocol_version = 'HTTP/1.1'
+    if args.latency is not None:
+        server.latency = server.LatencyModel(args.latency)
+    port = start_server(args.use_async)
+
+    # functions.py has its own copy of TOP_API_URL from "from common import *"
+    common.TOP_API_URL = functions.TOP_API_URL = f'http://{server.hostName}:{port}'
+    if args.limiter:
+        use_concurrency_limiter()
+
+    start_id = get_data_from_server(common.TOP_API_URL)['start_family_id']
+
+    rows = []
+    for part in parts:
+        for generations in range(1, args.generations + 1):
+            # the server prints a summary for every /start and /end
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                row = benchmark(part, generations, args.repeats, start_id)
+            rows.append(row)
+            print(f'part {part} {row["title"]:<32} gens {generations:>2}: p50 {row["p50_seconds"]:>8.3f}s '
+                  f'p95 {row["p95_seconds"]:>8.3f}s api {row["api_calls"]:>6} '
+                  f'threads {row["peak_server_threads"]:>4} {row["requests_per_second"]:>8.1f} req/s',
+                  file=sys.stderr)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    if not args.csv and not args.json:
+        writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
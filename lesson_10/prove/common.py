@@ -6,49 +6,599 @@ Author: <your name>
 Don't change this code.  You are not submitting it with your assignment
 
 """
+import sys
 import time
+import random
+import threading
+from array import array
+import collections
+import itertools
+import queue
+import asyncio
+import json
+import sqlite3
+import urllib.parse
 import requests
 
 from cse351 import *
 
 TOP_API_URL = 'http://127.0.0.1:8123'
 
+# Largest number of idle keep-alive connections kept by get_session()
+POOL_SIZE = 500
+
+# Number of ids sent in one /persons or /families request
+BATCH_SIZE = 50
+
+# Most requests sent at the same time by an AsyncClient
+ASYNC_CONNECTIONS = 200
+
+# Number of worker threads in a CrawlerPool or Prefetcher
+CRAWLER_WORKERS = 50
+
+# Number of locks in a ConcurrentTree
+TREE_STRIPES = 64
+
+# Lines written at a time by Tree.display()
+DISPLAY_CHUNK = 1000
+
+# Prefetcher priorities (lower goes first)
+PREFETCH_HIGH = 0
+PREFETCH_LOW = 1
+PREFETCH_DONE = 2
+
+# ResponseCache file, size and the routes it saves (use_response_cache())
+RESPONSE_CACHE_FILE = 'responses.db'
+RESPONSE_CACHE_ENTRIES = 200000
+CACHED_ROUTES = ('person', 'family', 'persons', 'families', 'pedigree')
+
+# Retries wait a random time up to BACKOFF_BASE * 2 ** retry (at most
+# BACKOFF_CAP) seconds, 429 and 503 replies are retried
+BACKOFF_BASE = 0.01
+BACKOFF_CAP = 1.0
+RETRY_STATUS = (429, 503)
+
+# ConcurrencyLimiter: starting, lowest and highest limits, a smoothed reply
+# time over LIMIT_TOLERANCE times the baseline lowers the limit
+LIMIT_INITIAL = 10
+LIMIT_MIN = 1
+LIMIT_MAX = 1000
+LIMIT_TOLERANCE = 2.0
+LIMIT_ERROR_DECREASE = 0.7
+LIMIT_LATENCY_DECREASE = 0.9
+LIMIT_RTT_SMOOTHING = 0.1
+LIMIT_BASELINE_DRIFT = 0.01
+
+_session = None
+_session_lock = threading.Lock()
+_cache = None
+_limiter = None
+
+# ----------------------------------------------------------------------------
+def get_session():
+    """ Shared requests session that reuses HTTP/1.1 connections to the server
+        (run the server with --keep-alive) """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+# ----------------------------------------------------------------------------
+class ResponseCache:
+    """ Replies from the server saved in a SQLite file, keyed by URL, so the
+        same records are not requested again between runs.  At most
+        max_entries replies are kept, the least recently used are removed
+        first.  The saved replies belong to one tree: when /start replies
+        with a different "tree" they are all removed. """
+
+    def __init__(self, filename=RESPONSE_CACHE_FILE, max_entries=RESPONSE_CACHE_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(url TEXT PRIMARY KEY, body TEXT NOT NULL, used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.db.execute('SELECT MAX(used) FROM responses').fetchone()
+        self.clock = itertools.count((row[0] or 0) + 1)
+        self.count = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, tree):
+        """ Called with the "tree" from a /start reply (None when the server
+            doesn't send one) """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'tree'").fetchone()
+            if tree is not None and row is not None and row[0] == tree:
+                return
+            self.db.execute('DELETE FROM responses')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tree', ?)", (tree,))
+            self.count = 0
+
+    def get(self, url):
+        """ Saved reply for url or None """
+        with self.lock:
+            row = self.db.execute('SELECT body FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE responses SET used = ? WHERE url = ?', (next(self.clock), url))
+        return json.loads(row[0])
+
+    def put(self, url, data):
+        body = json.dumps(data)
+        with self.lock:
+            cursor = self.db.execute('INSERT OR IGNORE INTO responses VALUES (?, ?, ?)',
+                                     (url, body, next(self.clock)))
+            self.count += cursor.rowcount
+            if self.count > self.max_entries:
+                # remove the least recently used tenth in one statement
+                extra = self.count - self.max_entries + self.max_entries // 10
+                self.db.execute('DELETE FROM responses WHERE url IN '
+                                '(SELECT url FROM responses ORDER BY used LIMIT ?)', (extra,))
+                self.count -= extra
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
 # ----------------------------------------------------------------------------
-def get_data_from_server(url):
+def use_response_cache(filename=RESPONSE_CACHE_FILE, max_entries=RESPONSE_CACHE_ENTRIES):
+    """ Save replies from get_data_from_server() in a ResponseCache """
+    global _cache
+    _cache = ResponseCache(filename, max_entries)
+    return _cache
+
+# ----------------------------------------------------------------------------
+class ConcurrencyLimiter:
+    """ Most requests in flight at the same time, shared by all the threads
+        that call get_data_from_server().  The limit is found with AIMD: it
+        goes up by one for every good reply (slow start) until the first
+        problem, then by 1/limit, but only while the limit is what holds the
+        requests back.  Connection errors, timeouts and 429 (too many
+        requests) replies cut it by LIMIT_ERROR_DECREASE.
+
+        Latency is watched with a smoothed reply time (EWMA) against a
+        baseline that follows its lowest value and slowly drifts back up, so
+        one slow reply or an old fast one don't count.  When the smoothed
+        time stays over tolerance times the baseline while the limit is full
+        the limit is cut by LIMIT_LATENCY_DECREASE.  Only one cut is made
+        for the requests that were already in flight. """
+
+    def __init__(self, initial=LIMIT_INITIAL, minimum=LIMIT_MIN, maximum=LIMIT_MAX,
+                 tolerance=LIMIT_TOLERANCE):
+        super().__init__()
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.peak = 0
+        self.rtt = None
+        self.baseline = None
+        self.slow_start = True
+        self.decreased = 0.0
+        self.error_cuts = 0
+        self.latency_cuts = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """ Wait for a free slot, returns the start time for release() """
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        return time.perf_counter()
+
+    def release(self, start, ok):
+        rtt = time.perf_counter() - start
+        with self.cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if not ok:
+                if self._decrease(start, LIMIT_ERROR_DECREASE):
+                    self.error_cuts += 1
+            else:
+                self._update_rtt(rtt)
+                if saturated and self.rtt > self.baseline * self.tolerance:
+                    if self._decrease(start, LIMIT_LATENCY_DECREASE):
+                        self.latency_cuts += 1
+                elif saturated:
+                    step = 1 if self.slow_start else 1 / self.limit
+                    self.limit = min(self.maximum, self.limit + step)
+            self.cond.notify(max(1, int(self.limit) - self.in_flight))
+
+    def _update_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = self.baseline = rtt
+            return
+        self.rtt += (rtt - self.rtt) * LIMIT_RTT_SMOOTHING
+        if self.rtt < self.baseline:
+            self.baseline = self.rtt
+        else:
+            # forget a fast baseline a little at a time
+            self.baseline += (self.rtt - self.baseline) * LIMIT_BASELINE_DRIFT
+
+    def _decrease(self, start, factor):
+        # requests sent before the last cut saw the same problem
+        if start <= self.decreased:
+            return False
+        self.slow_start = False
+        self.limit = max(self.minimum, self.limit * factor)
+        self.decreased = time.perf_counter()
+        return True
+
+
+# ----------------------------------------------------------------------------
+def use_concurrency_limiter(initial=LIMIT_INITIAL, minimum=LIMIT_MIN, maximum=LIMIT_MAX,
+                            tolerance=LIMIT_TOLERANCE):
+    """ Limit the requests in flight in get_data_from_server() """
+    global _limiter
+    _limiter = ConcurrencyLimiter(initial, minimum, maximum, tolerance)
+    return _limiter
+
+# ----------------------------------------------------------------------------
+def backoff_delay(attempt):
+    """ Exponential backoff with full jitter for retry number attempt """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+# ----------------------------------------------------------------------------
+def get_data_from_server(url, session=None):
+    route = urllib.parse.urlsplit(url).path.strip('/').split('/')[0] if _cache is not None else None
+    if route in CACHED_ROUTES:
+        data = _cache.get(url)
+        if data is not None:
+            return data
+
     retries = 50
-    delay = 0.01 # seconds
+    get = requests.get if session is None else session.get
     for i in range(retries):
+        start = _limiter.acquire() if _limiter is not None else None
+        response = None
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200:
-                return response.json()
+            response = get(url, timeout=10)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            pass
+
+        except requests.exceptions.RequestException as e:
             break
 
-        except requests.exceptions.ConnectionError as e:
+        finally:
+            if start is not None:
+                _limiter.release(start, response is not None and response.status_code != 429)
+
+        if response is None or response.status_code in RETRY_STATUS:
             if i < retries - 1:
-                time.sleep(delay)
+                time.sleep(backoff_delay(i))
             else:
                 print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
-            
+            continue
+
+        if response.status_code != 200:
+            break
+        try:
+            data = response.json()
         except requests.exceptions.RequestException as e:
             break
+        if route in CACHED_ROUTES and data is not None:
+            _cache.put(url, data)
+        elif route == 'start':
+            _cache.start(data.get('tree'))
+        return data
 
     return None
 
+# ----------------------------------------------------------------------------
+def get_batch_from_server(kind, ids, session=None):
+    """ Get many records with the batch API (kind is 'persons' or 'families').
+        The ids are split into groups of BATCH_SIZE and the groups are
+        requested at the same time.  Returns a dict of id -> data (None when
+        the server doesn't have the record) """
+    ids = list(dict.fromkeys(id for id in ids if id is not None))
+    groups = [ids[i:i + BATCH_SIZE] for i in range(0, len(ids), BATCH_SIZE)]
+    results = {}
+
+    def _get_group(group):
+        codes = ','.join(str(id) for id in group)
+        data = get_data_from_server(f'{TOP_API_URL}/{kind}?ids={codes}', session)
+        if data is not None:
+            results.update(zip(group, data))
+
+    threads = [threading.Thread(target=_get_group, args=(group,)) for group in groups[1:]]
+    for t in threads:
+        t.start()
+    if groups:
+        _get_group(groups[0])
+    for t in threads:
+        t.join()
+
+    return results
+
+# ----------------------------------------------------------------------------
+def get_pedigree_from_server(family_id, depth, session=None):
+    """ Get a family and its ancestors' families up to depth generations with
+        one request.  Returns {"id":, "depth":, "families": [...], "people": [...]} """
+    return get_data_from_server(f'{TOP_API_URL}/pedigree/{family_id}/{depth}', session)
+
+# ----------------------------------------------------------------------------
+class AsyncClient:
+    """ Small HTTP/1.1 client for the server built on asyncio.open_connection.
+        Connections are kept open and reused when the server allows it (run
+        the server with --keep-alive), and at most max_connections requests
+        are sent at the same time. """
+
+    def __init__(self, url=None, max_connections=ASYNC_CONNECTIONS):
+        super().__init__()
+        parts = urllib.parse.urlsplit(url if url is not None else TOP_API_URL)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+
+    async def get_data(self, path):
+        """ Returns the JSON data for the path (ie. /family/{id}) or None.
+            Connection errors and 429/503 replies are retried with the same
+            backoff as get_data_from_server() (without holding a slot) """
+        retries = 50
+        for i in range(retries):
+            async with self.slots:
+                status, body, reused = await self._get(path)
+            if status == 200 and body:
+                return json.loads(body)
+            if status is not None and status not in RETRY_STATUS:
+                return None
+            # the server might have closed an idle connection, try that
+            # again right away
+            if status is not None or not reused:
+                await asyncio.sleep(backoff_delay(i))
+
+        print("Max retries reached. Failing.")
+        return None
+
+    async def _get(self, path):
+        """ One try, returns (status code or None when it failed, body,
+            an idle connection was used) """
+        reused = bool(self.idle)
+        try:
+            if reused:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            return None, None, reused
+
+        try:
+            request = f'GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n\r\n'
+            writer.write(request.encode('latin-1'))
+            await writer.drain()
+            status, keep_alive, body = await self._read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            return None, None, reused
+
+        if keep_alive:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, body, reused
+
+    async def _read_response(self, reader):
+        """ Returns (status code, connection can be reused, body) """
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, status = status_line.decode('latin-1').split()[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        else:
+            # no length, the reply ends when the server closes the connection
+            body = await reader.read()
+            keep_alive = False
+
+        return int(status), keep_alive, body
+
+    async def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+# ----------------------------------------------------------------------------
+class CrawlerPool:
+    """ A fixed number of long lived worker threads.  Every worker has its own
+        deque of tasks: tasks submitted by a worker go on its own deque and it
+        takes the newest one first, an idle worker steals the oldest task from
+        another worker's deque.  At most `workers` tasks run at the same time
+        and no thread is created per request. """
+
+    def __init__(self, workers=CRAWLER_WORKERS):
+        super().__init__()
+        self.deques = [collections.deque() for _ in range(workers)]
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.next_deque = 0
+        self.stopping = False
+        self.threads = [threading.Thread(target=self._worker, args=(index,), daemon=True)
+                        for index in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, func, *args):
+        with self.condition:
+            self.pending += 1
+            index = getattr(self.local, 'index', None)
+            if index is None:
+                # not from a worker, spread the tasks over the deques
+                index = self.next_deque
+                self.next_deque = (self.next_deque + 1) % len(self.deques)
+            self.deques[index].append((func, args))
+            self.condition.notify()
+
+    def _take(self, index):
+        try:
+            return self.deques[index].pop()
+        except IndexError:
+            pass
+
+        count = len(self.deques)
+        for offset in range(1, count):
+            try:
+                return self.deques[(index + offset) % count].popleft()
+            except IndexError:
+                pass
+        return None
+
+    def _worker(self, index):
+        self.local.index = index
+        while True:
+            task = self._take(index)
+            if task is None:
+                with self.condition:
+                    if self.stopping:
+                        return
+                    task = self._take(index)
+                    if task is None:
+                        self.condition.wait()
+                        continue
+
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                print(f'ERROR: crawler task {func.__name__} failed: {e}')
+            finally:
+                with self.condition:
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.condition.notify_all()
+
+    def wait(self):
+        """ Wait until every submitted task (and the tasks they submitted) is done """
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+
+    def shutdown(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for t in self.threads:
+            t.join()
+
+# ----------------------------------------------------------------------------
+class Prefetcher:
+    """ Gets families and people with a fixed number of worker threads in
+        priority order and adds them to the tree.  Every Family and Person
+        that arrives is asked to prefetch() what the search needs next:
+        the husband and wife of a family (high priority), its children (low
+        priority) and a person's parents' family (high priority).  The walk
+        up the tree (family -> husband/wife -> parents' family) is never
+        stuck behind the children. """
+
+    def __init__(self, tree, workers=CRAWLER_WORKERS, session=None):
+        super().__init__()
+        self.tree = tree
+        self.workers = workers
+        self.session = session if session is not None else get_session()
+        self.lock = threading.Lock()
+        self.requested = set()
+        self.outstanding = 0
+        self.order = itertools.count()
+        self.q = queue.PriorityQueue()
+
+    def fetch_family(self, family_id, priority=PREFETCH_HIGH):
+        self._schedule(priority, 'family', family_id)
+
+    def fetch_person(self, person_id, priority=PREFETCH_HIGH):
+        self._schedule(priority, 'person', person_id)
+
+    def _schedule(self, priority, kind, id):
+        with self.lock:
+            if id is None or (kind, id) in self.requested:
+                return
+            self.requested.add((kind, id))
+            self.outstanding += 1
+        self.q.put((priority, next(self.order), kind, id))
+
+    def _worker(self):
+        while True:
+            _, _, kind, id = self.q.get()
+            if kind is None:
+                return
+            try:
+                data = get_data_from_server(f'{TOP_API_URL}/{kind}/{id}', self.session)
+                if data is not None:
+                    record = Family(data) if kind == 'family' else Person(data)
+                    with self.lock:
+                        if kind == 'family':
+                            self.tree.add_family(record)
+                        else:
+                            self.tree.add_person(record)
+                    record.prefetch(self)
+            finally:
+                with self.lock:
+                    self.outstanding -= 1
+                    done = self.outstanding == 0
+                if done:
+                    for _ in range(self.workers):
+                        self.q.put((PREFETCH_DONE, next(self.order), None, None))
+
+    def run(self, family_id):
+        """ Get the family and everything reachable from it """
+        threads = [threading.Thread(target=self._worker) for _ in range(self.workers)]
+        self.fetch_family(family_id)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
 # ----------------------------------------------------------------------------
 class Person:
+    # no __dict__ and shared name/birth strings, a 20 generation tree has
+    # millions of people
+    __slots__ = ('__id', '__name', '__parents', '__family', '__birth')
 
     def __init__(self, data):
         super().__init__()
         self.__id = data['id']
-        self.__name = data['name']
+        self.__name = sys.intern(data['name'])
         self.__parents = data['parent_id']
         self.__family = data['family_id']
-        self.__birth = data['birth']
+        self.__birth = sys.intern(data['birth'])
 
     def __str__(self):
         output  = f'id        : {self.__id}\n'
@@ -73,16 +623,22 @@ class Person:
     def get_familyid(self):
         return self.__family
 
+    def prefetch(self, prefetcher):
+        # the parents' family is next on the way up the tree
+        prefetcher.fetch_family(self.__parents, PREFETCH_HIGH)
+
 
 # ----------------------------------------------------------------------------
 class Family:
+    # children are kept in an array of 64 bit ids instead of a list of ints
+    __slots__ = ('__id', '__husband', '__wife', '__children')
 
     def __init__(self, data):
         super().__init__()
         self.__id = data['id']
         self.__husband = data['husband_id']
         self.__wife = data['wife_id']
-        self.__children = data['children']
+        self.__children = array('q', data['children'])
 
     def children_count(self):
         return len(self.__children)
@@ -105,11 +661,20 @@ class Family:
         return self.__wife
 
     def get_children(self):
-        return self.__children
+        return self.__children.tolist()
+
+    def prefetch(self, prefetcher):
+        # the husband and wife lead to the parents' families, the children
+        # are only needed for the tree
+        prefetcher.fetch_person(self.__husband, PREFETCH_HIGH)
+        prefetcher.fetch_person(self.__wife, PREFETCH_HIGH)
+        for id in self.__children:
+            prefetcher.fetch_person(id, PREFETCH_LOW)
 
 
 # -----------------------------------------------------------------------------
 class Tree:
+    __slots__ = ('__people', '__families', '__start_family_id')
 
     def __init__(self, start_family_id):
         super().__init__()
@@ -154,118 +719,206 @@ class Tree:
         return id in self.__families
 
     def display(self, log):
-        log.write('\n\n')
-        log.write(f'{" TREE DISPLAY ":*^40}')
-        for family_id in self.__families:
-            fam = self.__families[family_id]
-
-            log.write(f'Family id: {family_id}')
-
-            # Husband
-            husband = self.get_person(fam.get_husband())
-            if husband == None:
-                log.write(f'  Husband: None')
+        # the lines are joined and written DISPLAY_CHUNK at a time
+        lines = []
+
+        def write(line):
+            lines.append(line)
+            if len(lines) >= DISPLAY_CHUNK:
+                log.write('\n'.join(lines))
+                lines.clear()
+
+        def name(person):
+            return 'None' if person is None else person.get_name()
+
+        def parents(person):
+            if person is None:
+                return 'None'
+            parent_fam = self.__families.get(person.get_parentid())
+            if parent_fam is None:
+                return 'None'
+            father = self.__people.get(parent_fam.get_husband())
+            mother = self.__people.get(parent_fam.get_wife())
+            return f'{name(father)} and {name(mother)}'
+
+        write('\n\n')
+        write(f'{" TREE DISPLAY ":*^40}')
+        for family_id, fam in self.__families.items():
+            write(f'Family id: {family_id}')
+
+            husband = self.__people.get(fam.get_husband())
+            if husband is None:
+                write(f'  Husband: None')
             else:
-                log.write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
+                write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
 
-            # wife
-            wife = self.get_person(fam.get_wife())
-            if wife == None:
-                log.write(f'  Wife: None')
+            wife = self.__people.get(fam.get_wife())
+            if wife is None:
+                write(f'  Wife: None')
             else:
-                log.write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
-
-            # Parents of Husband
-            if husband == None:
-                log.write(f'  Husband Parents: None')
-            else:
-                parent_fam_id = husband.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Husband Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Husband Parents: None')
-
-            # Parents of Wife
-            if wife == None:
-                log.write(f'  Wife Parents: None')
-            else:
-                parent_fam_id = wife.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Wife Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Wife Parents: None')
-
-            # children
-            output = []
-            for index, child_id in enumerate(fam.get_children()):
-                person = self.__people[child_id]
-                output.append(f'{person.get_name()}')
-            out_str = str(output).replace("'", '', 100)
-            log.write(f'  Children: {out_str[1:-1]}')
-
-        log.write('')
-        log.write(f'Number of people                    : {len(self.__people)}')
-        log.write(f'Number of families                  : {len(self.__families)}')
-        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
-        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
+                write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
+
+            write(f'  Husband Parents: {parents(husband)}')
+            write(f'  Wife Parents: {parents(wife)}')
+
+            children = ', '.join(name(self.__people.get(child_id)) for child_id in fam.get_children())
+            write(f'  Children: {children}')
+
+        stats = self.analyze()
+        write('')
+        write(f'Number of people                    : {len(self.__people)}')
+        write(f'Number of families                  : {len(self.__families)}')
+        write(f'Max generations                     : {stats["generations"]}')
+        write(f'People connected to starting family : {stats["connected"]}')
+        write('')
+        write(f'Generation   Families     People')
+        for gen, (family_count, people_count) in enumerate(zip(stats['families_per_generation'],
+                                                               stats['people_per_generation'])):
+            write(f'{gen + 1:>10} {family_count:>10,} {people_count:>10,}')
+
+        if lines:
+            log.write('\n'.join(lines))
+
+
+    def analyze(self, family_id=None):
+        """ One pass over the families reachable from family_id (default the
+            starting family) through the husbands' and wives' parents.
+            Returns {'connected':, 'generations':, 'families_per_generation':
+            [...], 'people_per_generation': [...]}, people are counted in the
+            first generation they are seen in. """
+        if family_id is None:
+            family_id = self.__start_family_id
+
+        seen_families = {family_id}
+        seen_people = set()
+        families_per_gen = []
+        people_per_gen = []
+        level = [family_id]
+        while level:
+            next_level = []
+            found_families = 0
+            found_people = len(seen_people)
+            for id in level:
+                fam = self.__families.get(id)
+                if fam is None:
+                    continue
+                found_families += 1
+
+                for person_id in (fam.get_husband(), fam.get_wife()):
+                    person = self.__people.get(person_id)
+                    if person is None:
+                        continue
+                    seen_people.add(person_id)
+                    parent_id = person.get_parentid()
+                    if parent_id not in seen_families:
+                        seen_families.add(parent_id)
+                        next_level.append(parent_id)
+
+                seen_people.update(fam.get_children())
+
+            if found_families == 0:
+                break
+            families_per_gen.append(found_families)
+            people_per_gen.append(len(seen_people) - found_people)
+            level = next_level
+
+        return {'connected': len(seen_people),
+                'generations': len(families_per_gen),
+                'families_per_generation': families_per_gen,
+                'people_per_generation': people_per_gen}
 
 
     def _test_number_connected_to_start(self):
-        # start with first family, how many connected to that family
-        inds_seen = set()
+        return self.analyze()['connected']
 
-        def _recurive(family_id):
-            nonlocal inds_seen
-            if family_id in self.__families:
-                # count people in this family
-                fam = self.__families[family_id]
 
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    if husband.get_id() not in inds_seen:
-                        inds_seen.add(husband.get_id())
-                    _recurive(husband.get_parentid())
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    if wife.get_id() not in inds_seen:
-                        inds_seen.add(wife.get_id())
-                    _recurive(wife.get_parentid())
+    def _count_generations(self, family_id):
+        return self.analyze(family_id)['generations']
 
-                for child_id in fam.get_children():
-                    if child_id not in inds_seen:
-                        inds_seen.add(child_id)
+# -----------------------------------------------------------------------------
+class ConcurrentTree(Tree):
+    """ Tree that any number of crawler threads can share without a lock of
+        their own.  Ids are spread over `stripes` locks, so threads only wait
+        for each other when their ids land on the same stripe.
+        claim_family() / claim_person() replace the "with lock: if id in seen"
+        pattern: only the first caller for an id gets True. """
+    __slots__ = ('__locks', '__families_claimed', '__people_claimed')
+
+    def __init__(self, start_family_id, stripes=TREE_STRIPES):
+        super().__init__(start_family_id)
+        self.__locks = [threading.Lock() for _ in range(stripes)]
+        self.__families_claimed = [set() for _ in range(stripes)]
+        self.__people_claimed = [set() for _ in range(stripes)]
+
+    def __claim(self, claimed, id):
+        if id is None:
+            return False
+        stripe = hash(id) % len(self.__locks)
+        with self.__locks[stripe]:
+            if id in claimed[stripe]:
+                return False
+            claimed[stripe].add(id)
+            return True
+
+    def claim_family(self, id):
+        """ True the first time it is called for the family id """
+        return self.__claim(self.__families_claimed, id)
+
+    def claim_person(self, id):
+        """ True the first time it is called for the person id """
+        return self.__claim(self.__people_claimed, id)
 
+    def add_person(self, person):
+        with self.__locks[hash(person.get_id()) % len(self.__locks)]:
+            super().add_person(person)
 
-        _recurive(self.__start_family_id)
-        return len(inds_seen)
+    def add_family(self, family):
+        with self.__locks[hash(family.get_id()) % len(self.__locks)]:
+            super().add_family(family)
 
 
-    def _count_generations(self, family_id):
-        max_gen = -1
+class LockedTree:
+    """ The claim_family() / claim_person() / add_person() / add_family()
+        part of ConcurrentTree for a plain Tree, with one lock around the
+        tree and the claimed ids.  Made by shared_tree() for one crawl. """
+    __slots__ = ('__tree', '__lock', '__families_claimed', '__people_claimed')
 
-        def _recurive_gen(id, gen):
-            nonlocal max_gen
-            if id in self.__families:
-                if max_gen < gen:
-                    max_gen = gen
+    def __init__(self, tree):
+        super().__init__()
+        self.__tree = tree
+        self.__lock = threading.Lock()
+        self.__families_claimed = set()
+        self.__people_claimed = set()
+
+    def __claim(self, claimed, id):
+        if id is None:
+            return False
+        with self.__lock:
+            if id in claimed:
+                return False
+            claimed.add(id)
+            return True
+
+    def claim_family(self, id):
+        """ True the first time it is called for the family id """
+        return self.__claim(self.__families_claimed, id)
+
+    def claim_person(self, id):
+        """ True the first time it is called for the person id """
+        return self.__claim(self.__people_claimed, id)
 
-                fam = self.__families[id]
+    def add_person(self, person):
+        with self.__lock:
+            self.__tree.add_person(person)
 
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    _recurive_gen(husband.get_parentid(), gen + 1)
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    _recurive_gen(wife.get_parentid(), gen + 1)
+    def add_family(self, family):
+        with self.__lock:
+            self.__tree.add_family(family)
 
-        _recurive_gen(family_id, 0)
-        return max_gen + 1
 
+def shared_tree(tree):
+    """ The tree for crawler threads to share: a ConcurrentTree as it is,
+        a plain Tree in a LockedTree """
+    if isinstance(tree, ConcurrentTree):
+        return tree
+    return LockedTree(tree)
@@ -46,8 +46,8 @@ Describe how to speed up part 1
 I use depth-first search with threads. For each family I get the family data, then use
 threads to get all the people at the same time (husband, wife, kids). After adding them
 to the tree, I recursively go to the parent families. Threading lets me make multiple API
-calls at once which makes it way faster. I use a lock to keep the tree safe when adding
-things.
+calls at once which makes it way faster. The tree keeps itself safe when adding things
+and claim_family() / claim_person() make sure each id is only requested once.
 
 
 Describe how to speed up part 2
@@ -67,43 +67,46 @@ release it after, so it stays at 5 max.
 
 """
 from common import *
+import asyncio
+import itertools
 import queue
 import threading
 
+# Number of generations requested by pedigree_fs() (the server stops at the
+# top of the tree)
+PEDIGREE_DEPTH = 1000
+
+# Number of requests kept in flight by breadth_fs_pedigree_stream()
+STREAM_REQUESTS = 50
+
 # -----------------------------------------------------------------------------
 def depth_fs_pedigree(family_id, tree):
-    seen = set()
-    lock = threading.Lock()
+    # the tree does the locking and decides who gets each id (a plain Tree
+    # is shared through a LockedTree, see shared_tree())
+    tree = shared_tree(tree)
     
     def process_family(fam_id):
-        if fam_id is None:
+        if not tree.claim_family(fam_id):
             return
         
-        with lock:
-            if fam_id in seen:
-                return
-            seen.add(fam_id)
-        
         family_data = get_data_from_server(f'{TOP_API_URL}/family/{fam_id}')
         if family_data is None:
             return
         
         family = Family(family_data)
-        with lock:
-            tree.add_family(family)
+        tree.add_family(family)
         
         threads = []
         people = {}
         people_lock = threading.Lock()
         
         def get_person(person_id, name):
-            if person_id is None:
+            if not tree.claim_person(person_id):
                 return
             person_data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}')
             if person_data is not None:
                 person = Person(person_data)
-                with lock:
-                    tree.add_person(person)
+                tree.add_person(person)
                 if name:
                     with people_lock:
                         people[name] = person
@@ -145,11 +148,12 @@ def depth_fs_pedigree(family_id, tree):
 
 # -----------------------------------------------------------------------------
 def breadth_fs_pedigree(family_id, tree):
-    seen = set()
-    lock = threading.Lock()
+    # the tree does the locking and decides who gets each id (a plain Tree
+    # is shared through a LockedTree, see shared_tree())
+    tree = shared_tree(tree)
     q = queue.Queue()
+    tree.claim_family(family_id)
     q.put(family_id)
-    seen.add(family_id)
     
     def process_family(fam_id):
         family_data = get_data_from_server(f'{TOP_API_URL}/family/{fam_id}')
@@ -157,8 +161,7 @@ def breadth_fs_pedigree(family_id, tree):
             return []
         
         family = Family(family_data)
-        with lock:
-            tree.add_family(family)
+        tree.add_family(family)
         
         threads = []
         people = {}
@@ -166,13 +169,12 @@ def breadth_fs_pedigree(family_id, tree):
         parents = []
         
         def get_person(person_id, name):
-            if person_id is None:
+            if not tree.claim_person(person_id):
                 return
             person_data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}')
             if person_data is not None:
                 person = Person(person_data)
-                with lock:
-                    tree.add_person(person)
+                tree.add_person(person)
                 if name:
                     with people_lock:
                         people[name] = person
@@ -214,10 +216,8 @@ def breadth_fs_pedigree(family_id, tree):
             def worker(fam_id):
                 parent_ids = process_family(fam_id)
                 for parent_id in parent_ids:
-                    with lock:
-                        if parent_id not in seen:
-                            seen.add(parent_id)
-                            q.put(parent_id)
+                    if tree.claim_family(parent_id):
+                        q.put(parent_id)
             
             t = threading.Thread(target=worker, args=(fam_id,))
             t.start()
@@ -228,12 +228,13 @@ def breadth_fs_pedigree(family_id, tree):
 
 # -----------------------------------------------------------------------------
 def breadth_fs_pedigree_limit5(family_id, tree):
-    seen = set()
-    lock = threading.Lock()
+    # the tree does the locking and decides who gets each id (a plain Tree
+    # is shared through a LockedTree, see shared_tree())
+    tree = shared_tree(tree)
     sem = threading.Semaphore(5)
     q = queue.Queue()
+    tree.claim_family(family_id)
     q.put(family_id)
-    seen.add(family_id)
     
     def process_family(fam_id):
         sem.acquire()
@@ -244,23 +245,21 @@ def breadth_fs_pedigree_limit5(family_id, tree):
             return []
         
         family = Family(family_data)
-        with lock:
-            tree.add_family(family)
+        tree.add_family(family)
         
         threads = []
         people = {}
         parents = []
         
         def get_person(person_id, name):
-            if person_id is None:
+            if not tree.claim_person(person_id):
                 return
             sem.acquire()
             person_data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}')
             sem.release()
             if person_data is not None:
                 person = Person(person_data)
-                with lock:
-                    tree.add_person(person)
+                tree.add_person(person)
                 if name:
                     people[name] = person
         
@@ -301,14 +300,234 @@ def breadth_fs_pedigree_limit5(family_id, tree):
             def worker(fam_id):
                 parent_ids = process_family(fam_id)
                 for parent_id in parent_ids:
-                    with lock:
-                        if parent_id not in seen:
-                            seen.add(parent_id)
-                            q.put(parent_id)
+                    if tree.claim_family(parent_id):
+                        q.put(parent_id)
             
             t = threading.Thread(target=worker, args=(fam_id,))
             t.start()
             threads.append(t)
         
         for t in threads:
-            t.join()
\ No newline at end of file
+            t.join()
+
+# -----------------------------------------------------------------------------
+def breadth_fs_pedigree_batch(family_id, tree):
+    # Breadth first search with the batch API: one generation of families is
+    # retrieved with /families and everyone in those families with /persons
+    seen = {family_id}
+    level = [family_id]
+
+    while level:
+        family_data = get_batch_from_server('families', level)
+
+        families = []
+        for fam_id in level:
+            if family_data.get(fam_id) is not None:
+                family = Family(family_data[fam_id])
+                tree.add_family(family)
+                families.append(family)
+
+        # the husband and wife of a family are also children of their
+        # parents' family, so skip anyone that is already in the tree
+        person_ids = []
+        for family in families:
+            for person_id in [family.get_husband(), family.get_wife()] + family.get_children():
+                if not tree.does_person_exist(person_id):
+                    person_ids.append(person_id)
+
+        person_data = get_batch_from_server('persons', person_ids)
+        for data in person_data.values():
+            if data is not None:
+                tree.add_person(Person(data))
+
+        level = []
+        for family in families:
+            for parent_id in (family.get_husband(), family.get_wife()):
+                person = tree.get_person(parent_id)
+                if person is not None and person.get_parentid() and person.get_parentid() not in seen:
+                    seen.add(person.get_parentid())
+                    level.append(person.get_parentid())
+
+# -----------------------------------------------------------------------------
+def pedigree_fs(family_id, tree):
+    # The server walks the tree and sends everything back in one reply
+    data = get_pedigree_from_server(family_id, PEDIGREE_DEPTH)
+    if data is None:
+        return
+
+    for family_data in data['families']:
+        tree.add_family(Family(family_data))
+
+    for person_data in data['people']:
+        tree.add_person(Person(person_data))
+
+# -----------------------------------------------------------------------------
+def async_fs_pedigree(family_id, tree):
+    # Depth first search with asyncio: every request is a coroutine on one
+    # thread instead of a new thread
+    asyncio.run(_async_fs_pedigree(family_id, tree))
+
+
+async def _async_fs_pedigree(family_id, tree):
+    client = AsyncClient()
+    seen = set()
+    requested = set()
+
+    async def get_person(person_id):
+        if person_id is None or person_id in requested:
+            return None
+        requested.add(person_id)
+        person_data = await client.get_data(f'/person/{person_id}')
+        if person_data is None:
+            return None
+        person = Person(person_data)
+        tree.add_person(person)
+        return person
+
+    async def process_family(fam_id):
+        if fam_id is None or fam_id in seen:
+            return
+        seen.add(fam_id)
+
+        family_data = await client.get_data(f'/family/{fam_id}')
+        if family_data is None:
+            return
+
+        family = Family(family_data)
+        tree.add_family(family)
+
+        husband, wife, *children = await asyncio.gather(
+            get_person(family.get_husband()),
+            get_person(family.get_wife()),
+            *[get_person(child_id) for child_id in family.get_children()])
+
+        parents = [person.get_parentid() for person in (husband, wife) if person is not None]
+        await asyncio.gather(*[process_family(parent_id) for parent_id in parents])
+
+    try:
+        await process_family(family_id)
+    finally:
+        await client.close()
+
+# -----------------------------------------------------------------------------
+def pool_fs_pedigree(family_id, tree, workers=CRAWLER_WORKERS):
+    # A fixed pool of workers: a family's people are scheduled as soon as the
+    # family arrives and a parent family as soon as the husband or wife
+    # arrives, without waiting for the rest of the generation.  The
+    # ConcurrentTree does the locking and decides who gets each id (a plain
+    # Tree is shared through a LockedTree, see shared_tree()).
+    tree = shared_tree(tree)
+    session = get_session()
+    pool = CrawlerPool(workers)
+
+    def get_family(fam_id):
+        if tree.claim_family(fam_id):
+            pool.submit(process_family, fam_id)
+
+    def get_person(person_id, is_parent):
+        if tree.claim_person(person_id):
+            pool.submit(process_person, person_id, is_parent)
+
+    def process_family(fam_id):
+        family_data = get_data_from_server(f'{TOP_API_URL}/family/{fam_id}', session)
+        if family_data is None:
+            return
+
+        family = Family(family_data)
+        tree.add_family(family)
+
+        get_person(family.get_husband(), True)
+        get_person(family.get_wife(), True)
+        for child_id in family.get_children():
+            get_person(child_id, False)
+
+    def process_person(person_id, is_parent):
+        person_data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}', session)
+        if person_data is None:
+            return
+
+        person = Person(person_data)
+        tree.add_person(person)
+
+        if is_parent:
+            get_family(person.get_parentid())
+
+    get_family(family_id)
+    pool.wait()
+    pool.shutdown()
+
+# -----------------------------------------------------------------------------
+def breadth_fs_pedigree_stream(family_id, tree, k=STREAM_REQUESTS):
+    # Breadth first search without a barrier between generations: k threads
+    # each keep one request in flight.  The generation is only the priority
+    # of a request, so a parent family is requested as soon as the husband
+    # or wife arrives, even when other families of that generation are slow.
+    # The ConcurrentTree does the locking and decides who gets each id (a
+    # plain Tree is shared through a LockedTree, see shared_tree()).
+    tree = shared_tree(tree)
+    order = itertools.count()
+    q = queue.PriorityQueue()
+    session = get_session()
+
+    def schedule_family(generation, fam_id):
+        if tree.claim_family(fam_id):
+            q.put((generation, next(order), 'family', fam_id, False))
+
+    def schedule_person(generation, person_id, is_parent):
+        if tree.claim_person(person_id):
+            q.put((generation, next(order), 'person', person_id, is_parent))
+
+    def get_family(generation, fam_id):
+        family_data = get_data_from_server(f'{TOP_API_URL}/family/{fam_id}', session)
+        if family_data is None:
+            return
+
+        family = Family(family_data)
+        tree.add_family(family)
+
+        schedule_person(generation, family.get_husband(), True)
+        schedule_person(generation, family.get_wife(), True)
+        for child_id in family.get_children():
+            schedule_person(generation, child_id, False)
+
+    def get_person(generation, person_id, is_parent):
+        person_data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}', session)
+        if person_data is None:
+            return
+
+        person = Person(person_data)
+        tree.add_person(person)
+
+        if is_parent:
+            schedule_family(generation + 1, person.get_parentid())
+
+    def worker():
+        while True:
+            generation, _, kind, id, is_parent = q.get()
+            if kind is None:
+                return
+            try:
+                if kind == 'family':
+                    get_family(generation, id)
+                else:
+                    get_person(generation, id, is_parent)
+            finally:
+                # new requests are queued before this one is done, so
+                # q.join() only returns when nothing is left to request
+                q.task_done()
+
+    threads = [threading.Thread(target=worker) for _ in range(k)]
+    schedule_family(0, family_id)
+    for t in threads:
+        t.start()
+    q.join()
+    for _ in range(k):
+        q.put((float('inf'), next(order), None, None, False))
+    for t in threads:
+        t.join()
+
+# -----------------------------------------------------------------------------
+def prefetch_fs_pedigree(family_id, tree):
+    # The Family and Person records schedule the next requests themselves:
+    # husband and wife first, then their parents' families, children last
+    Prefetcher(tree).run(family_id)
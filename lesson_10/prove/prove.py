@@ -6,16 +6,44 @@ Author: <your name>
 Purpose: Assignment 10 - Family Search
 """
 from common import *
-from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5, breadth_fs_pedigree_batch, pedigree_fs, \
+                      async_fs_pedigree, pool_fs_pedigree, breadth_fs_pedigree_stream, prefetch_fs_pedigree
 
 from cse351 import *
 
 DFS = 'Depth First Search'
 BFS = 'Breadth First Search'
 BFS5 = 'Breadth First Search limit 5'
+BFS_BATCH = 'Breadth First Search batch API'
+PEDIGREE = 'Pedigree API'
+ASYNC_DFS = 'Depth First Search asyncio'
+POOL = 'Work stealing thread pool'
+BFS_STREAM = 'Breadth First Search pipelined'
+PREFETCH = 'Parent family prefetch'
+
+# part number in runs.txt -> (title, search function)
+PARTS = {
+    1: (DFS, depth_fs_pedigree),
+    2: (BFS, breadth_fs_pedigree),
+    3: (BFS5, breadth_fs_pedigree_limit5),
+    4: (BFS_BATCH, breadth_fs_pedigree_batch),
+    5: (PEDIGREE, pedigree_fs),
+    6: (ASYNC_DFS, async_fs_pedigree),
+    7: (POOL, pool_fs_pedigree),
+    8: (BFS_STREAM, breadth_fs_pedigree_stream),
+    9: (PREFETCH, prefetch_fs_pedigree),
+}
+
+# Keep the server's replies in RESPONSE_CACHE_FILE between runs (only useful
+# when the tree doesn't change, run the server with --lazy --seed N)
+USE_RESPONSE_CACHE = False
+
+# Let get_data_from_server() find how many requests the server can take at
+# the same time (ConcurrencyLimiter) instead of sending them all at once
+USE_CONCURRENCY_LIMITER = False
 
 def run_part(log, start_id, generations, title, func):
-    tree = Tree(start_id)
+    tree = ConcurrentTree(start_id)
 
     get_data_from_server(f'{TOP_API_URL}/start/{generations}')
 
@@ -37,8 +65,10 @@ def run_part(log, start_id, generations, title, func):
     log.write(f'People % Families / second    : {(tree.get_person_count()  + tree.get_family_count()) / total_time:.5f}')
     log.write('')
 
+    # a --lazy server sends null people when the tree is too large to count
+    server_people = 'unknown' if server_data["people"] is None else f'{server_data["people"]:,}'
     log.write(f'STATS        Retrieved | Server details')
-    log.write(f'People  :   {tree.get_person_count():>10,} | {server_data["people"]:>14,}')
+    log.write(f'People  :   {tree.get_person_count():>10,} | {server_people:>14}')
     log.write(f'Families:   {tree.get_family_count():>10,} | {server_data["families"]:>14,}')
     log.write(f'API Calls            : {server_data["api"]}')
     log.write(f'Max number of threads: {server_data["threads"]}')
@@ -47,6 +77,11 @@ def run_part(log, start_id, generations, title, func):
 def main():
     log = Log(show_terminal=True, filename_log='assignment.log')
 
+    if USE_RESPONSE_CACHE:
+        use_response_cache()
+    if USE_CONCURRENCY_LIMITER:
+        use_concurrency_limiter()
+
     # starting family
     data = get_data_from_server(f'{TOP_API_URL}')
     start_id = data['start_family_id']
@@ -60,12 +95,9 @@ def main():
             part_to_run = int(parts[0])
             generations = int(parts[1])
 
-            if part_to_run == 1:
-                run_part(log, start_id, generations, DFS, depth_fs_pedigree)
-            elif part_to_run == 2:
-                run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
-            elif part_to_run == 3:
-                run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+            if part_to_run in PARTS:
+                title, func = PARTS[part_to_run]
+                run_part(log, start_id, generations, title, func)
 
 
 if __name__ == '__main__':
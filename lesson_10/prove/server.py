@@ -9,6 +9,36 @@ Instructions:
 
 Open a terminal window and run this program
 
+API:
+    /                           starting family id
+    /start/{generations}        create a new family tree, "tree" in the reply
+                                changes when the tree does
+    /end                        summary of the requests
+    /metrics                    requests per route, latency percentiles and
+                                the highest number of requests at one time
+    /person/{id}
+    /family/{id}
+    /persons?ids={id},{id},...  many people in one request (same order as ids)
+    /families?ids={id},{id},... many families in one request (same order as ids)
+    /pedigree/{id}/{depth}      the family, its ancestors' families up to depth
+                                generations and all of their members (streamed)
+
+Options:
+    --async       serve requests with asyncio instead of one thread per request
+    --keep-alive  use HTTP/1.1 persistent connections (and pipelining)
+    --compact     build the tree in compact array columns (for 20+ generations)
+    --lazy        make families and people when they are first requested
+    --seed N      seed for --lazy trees and the id encoding (same seed = same replies)
+    --quiet       don't echo every request and reply to the terminal
+    --log-flush S seconds between flushes of server.log
+
+Latency and faults (default: every request waits SLEEP seconds):
+    --latency MODEL         fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA
+    --route-latency R=MODEL latency for one route, for example person=fixed:0.1
+    --rate-limit RATE,BURST token bucket, extra requests get a 429 reply
+    --error-rate P          part of the requests (0 to 1) that get a 503 reply
+    --latency-seed N        seed for the latency and error random numbers
+
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
@@ -26,7 +56,17 @@ import json
 import time
 import random
 import threading
-import ast
+import queue
+import atexit
+import asyncio
+import argparse
+import urllib.parse
+import bisect
+from array import array
+import functools
+import http
+import itertools
+import math
 
 hostName = "127.0.0.1"
 serverPort = 8123
@@ -34,6 +74,30 @@ serverPort = 8123
 SLEEP = 0.25
 MAX_GENERATIONS = 6
 
+# HTTP/1.1 persistent connections (--keep-alive)
+KEEP_ALIVE = False
+
+# Number of records written at a time by /pedigree
+PEDIGREE_CHUNK = 100
+
+# Log file writer: seconds between flushes and most lines written at a time
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH = 1000
+
+# Don't echo every request and reply to the terminal (--quiet)
+QUIET = False
+
+# Build the tree in array columns (--compact)
+COMPACT_TREE = False
+
+# Make families and people when they are requested (--lazy, --seed)
+LAZY_TREE = False
+LAZY_SEED = 0
+LAZY_CACHE_SIZE = 100000
+# /end counts the people of lazy trees up to this many families, larger
+# trees report the count as unknown
+LAZY_COUNT_LIMIT = 2 ** 16
+
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
             5000008127, 5000008133, 5000008147, 5000008151, 5000008201, 5000008219, 5000008271, 5000008297, 5000008313, 5000008319,
@@ -71,11 +135,6 @@ surnames = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis',
             'Pérez', 'Sánchez', 'Ramírez', 'Flores', 'Gómez', 'Torres', 'Díaz', 'Vásquez', 
             'Cruz', 'Morales', 'Gutiérrez', 'Reyes', 'Ruíz', 'Jiménez')
 
-max_thread_count = 0
-call_count = 0
-thread_count = 0
-lock = threading.Lock()
-
 family_request_order = []
 people = {}
 families = {}
@@ -115,25 +174,208 @@ def decode(code: int):
         return (code ^ PRIME) // ID
 
 class Log:
+    """ write() only puts the line on a queue.  A background thread writes the
+        lines to the file in batches and flushes it every flush_interval
+        seconds, so request threads never wait on the disk """
 
-    def __init__(self, filename):
+    def __init__(self, filename, flush_interval=LOG_FLUSH_INTERVAL):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.flush_interval = flush_interval
         self.file = open(filename, 'w')
+        self.lines = queue.SimpleQueue()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+        self.lines.put(line)
+
+    def write_reply(self, prefix, data):
+        """ write(prefix + data decoded), the writer thread does the decoding
+            so a cached reply isn't turned back into a str per request """
+        self.lines.put((prefix, data))
+
+    def _write_lines(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            batch = []
+            try:
+                batch.append(self.lines.get(timeout=self.flush_interval))
+                while len(batch) < LOG_BATCH:
+                    batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                pass
+
+            # None is put on the queue by close()
+            done = None in batch
+            lines = [line if isinstance(line, str) else line[0] + line[1].decode('utf8')
+                     for line in batch if line is not None]
+            if lines:
+                self.file.write('\n'.join(lines))
+                self.file.write('\n')
+
+            if done or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
 
-    def __del__(self):
         self.file.close()
 
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.writer.join()
+
 # Global log object
 log = Log('server.log')
 
+# ----------------------------------------------------------------------------
+# Request metrics
+#
+# Requests are counted in METRICS_SHARDS MetricsShards picked by thread id,
+# each with its own lock, so threads only wait for each other when they land
+# on the same shard.  The number of shards doesn't grow with the number of
+# threads or requests.  The shards are merged when /end or /metrics asks for
+# the totals.
+#
+# The highest number of requests in progress at the same time is worked out
+# exactly: every start and finish takes a number from one itertools.count()
+# (next() is atomic), and the merged start/finish events are replayed in that
+# order.  The active/max numbers shown while requests run are only an
+# estimate.
+# ----------------------------------------------------------------------------
+ROUTES = ('start', 'end', 'metrics', 'person', 'family', 'persons', 'families', 'pedigree')
+METRICS_SHARDS = 64
+
+class MetricsShard:
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.starts = array('q')
+        self.finishes = array('q')
+        self.calls = {}
+        self.latencies = {}
+
+
+class RequestTimer:
+
+    __slots__ = ('shard', 'route', 'start_time')
+
+    def __init__(self, shard, route, start_time):
+        self.shard = shard
+        self.route = route
+        self.start_time = start_time
+
+
+class Metrics:
+
+    def __init__(self):
+        super().__init__()
+        self.order = itertools.count()
+        self.started = itertools.count(1)
+        self.finished = itertools.count(1)
+        self.last_finished = 0
+        self.max_seen = 0
+        self.shards = [MetricsShard() for _ in range(METRICS_SHARDS)]
+
+    def _shard(self):
+        # thread ids are addresses, mix the bits before picking a shard
+        return self.shards[(threading.get_ident() * 0x9E3779B97F4A7C15 >> 32) % METRICS_SHARDS]
+
+    def _start(self, request):
+        shard = request.shard
+        with shard.lock:
+            shard.starts.append(next(self.order))
+            shard.calls[request.route] = shard.calls.get(request.route, 0) + 1
+
+    def request_started(self, path):
+        """ Returns (request timer, estimated active requests, estimated max) """
+        route = path.split('?')[0].split('/')[1] if '/' in path else ''
+        if route not in ROUTES:
+            route = '/'
+
+        request = RequestTimer(self._shard(), route, time.perf_counter())
+        self._start(request)
+
+        active = next(self.started) - self.last_finished
+        if active > self.max_seen:
+            self.max_seen = active
+        return request, active, self.max_seen
+
+    def request_finished(self, request):
+        shard = request.shard
+        latency = time.perf_counter() - request.start_time
+        with shard.lock:
+            shard.finishes.append(next(self.order))
+            shard.latencies.setdefault(request.route, array('d')).append(latency)
+
+        finished = next(self.finished)
+        if finished > self.last_finished:
+            self.last_finished = finished
+
+    def reset(self, request=None):
+        """ Start counting again (used by /start).  The request that asked for
+            the reset is counted as the first request """
+        # requests that are still running finish in the old shards
+        self.shards = [MetricsShard() for _ in range(METRICS_SHARDS)]
+        self.started = itertools.count(1)
+        self.finished = itertools.count(1)
+        self.last_finished = 0
+        self.max_seen = 0
+
+        if request != None:
+            request.shard = self._shard()
+            self._start(request)
+            next(self.started)
+            self.max_seen = 1
+
+    def totals(self):
+        """ Merge the shards: number of requests, highest number of requests in
+            progress at the same time, requests and latencies for each route """
+        events = []
+        calls = {}
+        latencies = {}
+        for shard in self.shards:
+            with shard.lock:
+                events.extend((order, 1) for order in shard.starts)
+                events.extend((order, -1) for order in shard.finishes)
+                for route, count in shard.calls.items():
+                    calls[route] = calls.get(route, 0) + count
+                for route, values in shard.latencies.items():
+                    latencies.setdefault(route, []).extend(values)
+
+        active = 0
+        max_active = 0
+        for _, change in sorted(events):
+            active += change
+            if active > max_active:
+                max_active = active
+
+        routes = {}
+        for route in sorted(calls):
+            values = sorted(latencies.get(route, []))
+            routes[route] = {'calls': calls[route], 'finished': len(values)}
+            for name, percent in (('p50', 50), ('p90', 90), ('p99', 99)):
+                routes[route][name] = percentile(values, percent)
+            routes[route]['max'] = round(values[-1], 4) if values else None
+
+        return {'api': sum(calls.values()), 'threads': max_active, 'active': active, 'routes': routes}
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile of sorted latencies (seconds, to 0.1 ms) """
+    if not values:
+        return None
+    index = max(0, math.ceil(percent / 100 * len(values)) - 1)
+    return round(values[index], 4)
+
+
+metrics = Metrics()
+
 # ----------------------------------------------------------------------------
 class Person:
     
@@ -278,172 +520,1032 @@ def build_tree(gens):
     log.write(f'Number of people  : {len(people)}')
     log.write(f'Number of families: {len(families)}')
 
-    
+
 # ----------------------------------------------------------------------------
-class Handler(BaseHTTPRequestHandler):
+# Compact family tree (--compact)
+#
+# build_tree() makes a Person object with a date string for everyone and
+# recurses once per family, so large trees hit the recursion limit and use a
+# lot of memory.  build_compact_tree() makes the same shape of tree with a
+# loop and keeps it in array columns:
+#
+#   - every family gets a block of person ids: husband, wife and then its
+#     own children, so a family only stores its first person id and the
+#     number of children
+#   - a person only stores a name index (into NAMES) and a birth day number
+#   - the husband and wife are also children of their parents' family, that
+#     is the family's extra child
+#
+# CompactPeople and CompactFamilies are read only views of the columns that
+# work like the people and families dictionaries.
+# ----------------------------------------------------------------------------
+NAMES = male_names + female_names
+FIRST_BIRTH = datetime.date(1753, 1, 1).toordinal()
+BIRTH_DAYS = (datetime.date(2020, 1, 1) - datetime.date(1753, 1, 1)).days
+
+class CompactTree:
+
+    def __init__(self, gens):
+        super().__init__()
+        number_families = 2 ** gens - 1 if gens > 0 else 0
+        child_counts = random.choices(range(2, 9), k=number_families)
+
+        # family columns (family id - 1 is the index, 0 means None)
+        self.first_person = array('q')
+        self.child_count = array('B', child_counts)
+        self.husband_parents = array('q', bytes(8 * number_families))
+        self.wife_parents = array('q', bytes(8 * number_families))
+        self.extra_child = array('q')
+
+        # (generation, family id of the child, 0 = husband / 1 = wife)
+        stack = [(gens, 0, 0)] if gens > 0 else []
+        next_person_id = 1
+        while stack:
+            generation, child_family, side = stack.pop()
+
+            family_id = len(self.first_person) + 1
+            self.first_person.append(next_person_id)
+            next_person_id += 2 + child_counts[family_id - 1]
+
+            if child_family:
+                self.extra_child.append(self.first_person[child_family - 1] + side)
+                if side == 0:
+                    self.husband_parents[child_family - 1] = family_id
+                else:
+                    self.wife_parents[child_family - 1] = family_id
+            else:
+                self.extra_child.append(0)
+
+            # the husband's parents are popped (and numbered) first
+            if generation > 1:
+                stack.append((generation - 1, family_id, 1))
+                stack.append((generation - 1, family_id, 0))
+
+        # person columns (the person id is the index, index 0 is not used)
+        self.person_count = next_person_id - 1
+        self.names = array('B', random.choices(range(len(NAMES)), k=next_person_id))
+        self.births = array('i', random.choices(range(BIRTH_DAYS), k=next_person_id))
+
+    def find_family(self, person_id):
+        """ Family whose block of ids has this person """
+        return bisect.bisect_right(self.first_person, person_id)
+
+
+class CompactPerson:
+
+    __slots__ = ('tree', 'id', 'block_family', 'offset')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+        self.block_family = tree.find_family(id)
+        self.offset = id - tree.first_person[self.block_family - 1]
+
+    @property
+    def name(self):
+        index = self.tree.names[self.id]
+        # husbands and wives are picked from their own list of names
+        if self.offset == 0:
+            return male_names[index % len(male_names)]
+        if self.offset == 1:
+            return female_names[index % len(female_names)]
+        return NAMES[index]
+
+    @property
+    def birth(self):
+        date = datetime.date.fromordinal(FIRST_BIRTH + self.tree.births[self.id])
+        return f'{date.day}-{date.month}-{date.year}'
+
+    @property
+    def parents(self):
+        if self.offset == 0:
+            parents = self.tree.husband_parents[self.block_family - 1]
+        elif self.offset == 1:
+            parents = self.tree.wife_parents[self.block_family - 1]
+        else:
+            parents = self.block_family
+        return parents if parents else None
+
+    @property
+    def family(self):
+        return self.block_family if self.offset < 2 else None
+
+    def get_dict(self):
+        person_dict = {}
+
+        person_dict["id"] = encode(self.id)
+        person_dict["name"] = self.name
+        person_dict["birth"] = self.birth
+        person_dict["parent_id"] = encode(self.parents)
+        person_dict["family_id"] = encode(self.family)
+
+        return person_dict
+
+
+class CompactFamily:
+
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+
+    @property
+    def husband(self):
+        return self.tree.first_person[self.id - 1]
+
+    @property
+    def wife(self):
+        return self.tree.first_person[self.id - 1] + 1
+
+    @property
+    def children(self):
+        first = self.tree.first_person[self.id - 1] + 2
+        ids = list(range(first, first + self.tree.child_count[self.id - 1]))
+        if self.tree.extra_child[self.id - 1]:
+            ids.append(self.tree.extra_child[self.id - 1])
+        return ids
+
+    def get_dict(self):
+        family_dict = {}
+
+        family_dict["id"] = encode(self.id)
+        family_dict["husband_id"] = encode(self.husband)
+        family_dict["wife_id"] = encode(self.wife)
+        family_dict["children"] = [encode(id) for id in self.children]
+
+        return family_dict
+
+
+class CompactPeople:
+
+    def __init__(self, tree):
+        super().__init__()
+        self.tree = tree
+
+    def __len__(self):
+        return self.tree.person_count
+
+    def __contains__(self, id):
+        return isinstance(id, int) and 1 <= id <= self.tree.person_count
+
+    def __getitem__(self, id):
+        if id not in self:
+            raise KeyError(id)
+        return CompactPerson(self.tree, id)
+
+
+class CompactFamilies:
+
+    def __init__(self, tree):
+        super().__init__()
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree.first_person)
+
+    def __contains__(self, id):
+        return isinstance(id, int) and 1 <= id <= len(self.tree.first_person)
+
+    def __getitem__(self, id):
+        if id not in self:
+            raise KeyError(id)
+        return CompactFamily(self.tree, id)
+
+
+def build_compact_tree(gens):
+    global people
+    global families
+    global log
+
+    tree = CompactTree(gens)
+    people = CompactPeople(tree)
+    families = CompactFamilies(tree)
+
+    print(f'Number of people  : {len(people)}')
+    print(f'Number of families: {len(families)}')
+    log.write(f'Number of people  : {len(people)}')
+    log.write(f'Number of families: {len(families)}')
+
+
+# ----------------------------------------------------------------------------
+# Lazy family tree (--lazy)
+#
+# Nothing is built by /start.  A family or person is worked out from
+# (seed, id) the first time it is requested with a counter based random
+# number generator (splitmix64), so the same seed always gives the same tree
+# and the memory used only depends on the records that are requested.
+#
+# Families are numbered like a heap: the parents of the husband of family f
+# are family 2f and the parents of the wife are family 2f + 1.  The people of
+# family f have the ids f * 16 + slot: slot 0 is the husband, slot 1 the wife
+# and slots 2 and up are the family's own children.
+# ----------------------------------------------------------------------------
+LAZY_SLOTS = 16
+MASK64 = (1 << 64) - 1
+
+# random number streams
+LAZY_CHILDREN = 0
+LAZY_NAME = 1
+LAZY_BIRTH = 2
+
+def lazy_random(seed, id, stream):
+    """ Random 64 bit number for (seed, id, stream) """
+    z = (seed + (id * 4 + stream + 1) * 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+class LazyPerson:
+
+    __slots__ = ('id', 'name', 'birth', 'parents', 'family')
+
+    def __init__(self, id, name, birth, parents, family):
+        self.id = id
+        self.name = name
+        self.birth = birth
+        self.parents = parents
+        self.family = family
+
+    def get_dict(self):
+        person_dict = {}
+
+        person_dict["id"] = encode(self.id)
+        person_dict["name"] = self.name
+        person_dict["birth"] = self.birth
+        person_dict["parent_id"] = encode(self.parents)
+        person_dict["family_id"] = encode(self.family)
+
+        return person_dict
+
+
+class LazyFamily:
+
+    __slots__ = ('id', 'husband', 'wife', 'children')
+
+    def __init__(self, id, husband, wife, children):
+        self.id = id
+        self.husband = husband
+        self.wife = wife
+        self.children = children
+
+    def get_dict(self):
+        family_dict = {}
+
+        family_dict["id"] = encode(self.id)
+        family_dict["husband_id"] = encode(self.husband)
+        family_dict["wife_id"] = encode(self.wife)
+        family_dict["children"] = [encode(id) for id in self.children]
+
+        return family_dict
+
+
+class LazyTree:
 
-    def get_person(self, id):
-        global people
-        if id in people:
-            return people[id].get_dict()
+    def __init__(self, gens, seed, cache_size):
+        super().__init__()
+        self.gens = gens
+        self.seed = seed
+        self.family_count = 2 ** gens - 1 if gens > 0 else 0
+        self.person_count = None
+
+        # records are made on first access and kept in an LRU cache
+        self.get_family = functools.lru_cache(maxsize=cache_size)(self._make_family)
+        self.get_person = functools.lru_cache(maxsize=cache_size)(self._make_person)
+
+        # and so are their encoded replies, person_replies and family_replies
+        # would keep every record that was ever sent
+        self.get_family_reply = functools.lru_cache(maxsize=cache_size)(self._make_family_reply)
+        self.get_person_reply = functools.lru_cache(maxsize=cache_size)(self._make_person_reply)
+
+    def child_count(self, family_id):
+        return 2 + lazy_random(self.seed, family_id, LAZY_CHILDREN) % 7
+
+    def has_family(self, family_id):
+        return isinstance(family_id, int) and 1 <= family_id <= self.family_count
+
+    def has_person(self, person_id):
+        if not isinstance(person_id, int):
+            return False
+        family_id, slot = divmod(person_id, LAZY_SLOTS)
+        return self.has_family(family_id) and slot < 2 + self.child_count(family_id)
+
+    def count_people(self):
+        # walks every family, so it is None (unknown) for large trees
+        if self.person_count is None and self.family_count <= LAZY_COUNT_LIMIT:
+            self.person_count = sum(2 + self.child_count(id) for id in range(1, self.family_count + 1))
+        return self.person_count
+
+    def _make_family(self, family_id):
+        first = family_id * LAZY_SLOTS
+        children = list(range(first + 2, first + 2 + self.child_count(family_id)))
+        if family_id > 1:
+            # husband (even family id) or wife (odd) of the child's family
+            children.append((family_id // 2) * LAZY_SLOTS + family_id % 2)
+        return LazyFamily(family_id, first, first + 1, children)
+
+    def _make_family_reply(self, family_id):
+        return json.dumps(self.get_family(family_id).get_dict()).encode('utf8')
+
+    def _make_person_reply(self, person_id):
+        return json.dumps(self.get_person(person_id).get_dict()).encode('utf8')
+
+    def _make_person(self, person_id):
+        family_id, slot = divmod(person_id, LAZY_SLOTS)
+
+        value = lazy_random(self.seed, person_id, LAZY_NAME)
+        if slot == 0:
+            name = male_names[value % len(male_names)]
+        elif slot == 1:
+            name = female_names[value % len(female_names)]
         else:
+            name = NAMES[value % len(NAMES)]
+
+        days = lazy_random(self.seed, person_id, LAZY_BIRTH) % BIRTH_DAYS
+        date = datetime.date.fromordinal(FIRST_BIRTH + days)
+        birth = f'{date.day}-{date.month}-{date.year}'
+
+        if slot < 2:
+            parents = family_id * 2 + slot
+            if not self.has_family(parents):
+                parents = None
+            return LazyPerson(person_id, name, birth, parents, family_id)
+
+        return LazyPerson(person_id, name, birth, family_id, None)
+
+
+class LazyPeople:
+
+    def __init__(self, tree):
+        super().__init__()
+        self.tree = tree
+
+    def __contains__(self, id):
+        return self.tree.has_person(id)
+
+    def __getitem__(self, id):
+        if id not in self:
+            raise KeyError(id)
+        return self.tree.get_person(id)
+
+
+class LazyFamilies:
+
+    def __init__(self, tree):
+        super().__init__()
+        self.tree = tree
+
+    def __len__(self):
+        return self.tree.family_count
+
+    def __contains__(self, id):
+        return self.tree.has_family(id)
+
+    def __getitem__(self, id):
+        if id not in self:
+            raise KeyError(id)
+        return self.tree.get_family(id)
+
+
+def build_lazy_tree(gens):
+    global people
+    global families
+    global log
+
+    tree = LazyTree(gens, LAZY_SEED, LAZY_CACHE_SIZE)
+    people = LazyPeople(tree)
+    families = LazyFamilies(tree)
+
+    print(f'Lazy tree with seed {LAZY_SEED}')
+    print(f'Number of families: {len(families)}')
+    log.write(f'Lazy tree with seed {LAZY_SEED}')
+    log.write(f'Number of families: {len(families)}')
+
+
+def count_people():
+    """ Number of people in the tree, None for lazy trees that are too large to count """
+    if isinstance(people, LazyPeople):
+        return people.tree.count_people()
+    return len(people)
+
+
+# ----------------------------------------------------------------------------
+# Latency and fault model (--latency, --route-latency, --rate-limit,
+# --error-rate, --latency-seed)
+#
+# Instead of always sleeping SLEEP seconds, every request asks the model how
+# long to wait and whether to fail.  The random numbers come from
+# lazy_random() with the request number as the counter, so a seed gives the
+# same delays and errors for the same order of requests.
+# ----------------------------------------------------------------------------
+LATENCY_STREAM = 3
+
+class FixedLatency:
+
+    def __init__(self, seconds):
+        super().__init__()
+        self.seconds = seconds
+
+    def delay(self, draw):
+        return self.seconds
+
+
+class UniformLatency:
+
+    def __init__(self, low, high):
+        super().__init__()
+        self.low = low
+        self.high = high
+
+    def delay(self, draw):
+        return self.low + (self.high - self.low) * draw(1)
+
+
+class LognormalLatency:
+    """ Long tailed delay: median seconds, sigma is the spread of log(delay) """
+
+    def __init__(self, median, sigma):
+        super().__init__()
+        self.mu = math.log(median)
+        self.sigma = sigma
+
+    def delay(self, draw):
+        # Box-Muller transform of two uniform numbers
+        normal = math.sqrt(-2 * math.log(1 - draw(1))) * math.cos(2 * math.pi * draw(2))
+        return math.exp(self.mu + self.sigma * normal)
+
+
+class TokenBucket:
+    """ Allows rate requests a second with bursts of up to burst requests """
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class LatencyModel:
+
+    def __init__(self, default, routes=None, bucket=None, error_rate=0.0, seed=0):
+        super().__init__()
+        self.default = default
+        self.routes = routes if routes != None else {}
+        self.bucket = bucket
+        self.error_rate = error_rate
+        self.seed = seed
+        self.requests = itertools.count()
+
+    def decide(self, route):
+        """ Returns (seconds to wait, error status or None) """
+        number = next(self.requests)
+
+        def draw(index):
+            return lazy_random(self.seed, number * 8 + index, LATENCY_STREAM) / 2 ** 64
+
+        if self.bucket != None and not self.bucket.take():
+            return 0, 429
+
+        delay = self.routes.get(route, self.default).delay(draw)
+        if self.error_rate > 0 and draw(0) < self.error_rate:
+            return delay, 503
+        return delay, None
+
+
+def parse_latency(text):
+    """ fixed:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA """
+    kind, _, values = text.partition(':')
+    numbers = [float(value) for value in values.split(',') if value]
+    if kind == 'fixed' and len(numbers) == 1:
+        return FixedLatency(numbers[0])
+    if kind == 'uniform' and len(numbers) == 2:
+        return UniformLatency(numbers[0], numbers[1])
+    if kind == 'lognormal' and len(numbers) == 2:
+        return LognormalLatency(numbers[0], numbers[1])
+    raise argparse.ArgumentTypeError(f'bad latency "{text}" (use fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA)')
+
+
+def parse_route_latency(text):
+    """ ROUTE=LATENCY, for example person=uniform:0.1,0.4 """
+    route, _, model = text.partition('=')
+    if route not in ROUTES:
+        raise argparse.ArgumentTypeError(f'unknown route "{route}" (one of {", ".join(ROUTES)})')
+    return route, parse_latency(model)
+
+
+def parse_rate_limit(text):
+    """ RATE or RATE,BURST in requests a second """
+    numbers = [float(value) for value in text.split(',')]
+    if len(numbers) not in (1, 2) or numbers[0] <= 0:
+        raise argparse.ArgumentTypeError(f'bad rate limit "{text}" (use RATE or RATE,BURST)')
+    # a request takes a whole token, a smaller bucket would refuse them all
+    if len(numbers) == 2 and numbers[1] < 1:
+        raise argparse.ArgumentTypeError(f'bad rate limit "{text}" (BURST must be at least 1)')
+    return TokenBucket(numbers[0], numbers[1] if len(numbers) == 2 else max(1, numbers[0]))
+
+
+def parse_error_rate(text):
+    """ part of the requests, 0 to 1 """
+    rate = float(text)
+    if not 0 <= rate <= 1:
+        raise argparse.ArgumentTypeError(f'bad error rate "{text}" (use 0 to 1)')
+    return rate
+
+
+latency = LatencyModel(FixedLatency(SLEEP))
+
+
+# ----------------------------------------------------------------------------
+# Encoded JSON reply for each record (id -> bytes).  They are made the first
+# time a record is requested and thrown away by /start.
+person_replies = {}
+family_replies = {}
+
+def get_person_reply(id):
+    if isinstance(people, LazyPeople):
+        return people.tree.get_person_reply(id) if id in people else None
+
+    reply = person_replies.get(id)
+    if reply == None and id in people:
+        reply = json.dumps(people[id].get_dict()).encode('utf8')
+        person_replies[id] = reply
+    return reply
+
+
+def get_family_reply(id):
+    if isinstance(families, LazyFamilies):
+        return families.tree.get_family_reply(id) if id in families else None
+
+    reply = family_replies.get(id)
+    if reply == None and id in families:
+        reply = json.dumps(families[id].get_dict()).encode('utf8')
+        family_replies[id] = reply
+    return reply
+
+
+def stream_pedigree(family_id, depth):
+    """ Yields the /pedigree JSON document in pieces: the family, its parents'
+        families and so on up to depth generations, then everyone that is
+        a member of those families """
+    global family_request_order
+
+    yield f'{{"id": {encode(family_id)}, "depth": {depth}, "families": ['.encode('utf8')
+
+    people_ids = []
+    people_seen = set()
+    families_seen = {family_id}
+    level = [family_id]
+    generation = 0
+    count = 0
+    pieces = []
+
+    while level and generation < depth:
+        next_level = []
+        for id in level:
+            family = families[id].get_dict()
+            family_request_order.append(id)
+            pieces.append(get_family_reply(id))
+
+            codes = [family['husband_id'], family['wife_id']] + family['children']
+            for code in codes:
+                if code == None:
+                    continue
+                person_id = decode(code)
+                if person_id not in people_seen:
+                    people_seen.add(person_id)
+                    people_ids.append(person_id)
+
+            # parents' families of the husband and wife
+            for code in codes[:2]:
+                if code == None or decode(code) not in people:
+                    continue
+                parents = people[decode(code)].parents
+                if parents != None and parents in families and parents not in families_seen:
+                    families_seen.add(parents)
+                    next_level.append(parents)
+
+            if len(pieces) >= PEDIGREE_CHUNK:
+                yield (b', ' if count else b'') + b', '.join(pieces)
+                count += len(pieces)
+                pieces = []
+
+        level = next_level
+        generation += 1
+
+    if pieces:
+        yield (b', ' if count else b'') + b', '.join(pieces)
+
+    yield b'], "people": ['
+
+    count = 0
+    pieces = []
+    for person_id in people_ids:
+        reply = get_person_reply(person_id)
+        if reply != None:
+            pieces.append(reply)
+        if len(pieces) >= PEDIGREE_CHUNK:
+            yield (b', ' if count else b'') + b', '.join(pieces)
+            count += len(pieces)
+            pieces = []
+
+    if pieces:
+        yield (b', ' if count else b'') + b', '.join(pieces)
+
+    yield b']}'
+
+
+def request_started(path):
+    global log
+
+    request, active, max_active = metrics.request_started(path)
+    if not QUIET:
+        print(f'Current: active threads / max count: {active} / {max_active}')
+    log.write(f'Current: active threads / max count: {active} / {max_active}')
+
+    if not QUIET:
+        print('- ' * 35)
+        print(f'Request: {path}')
+
+    log.write(f'Request: {path}')
+    return request
+
+
+def request_finished(request):
+    metrics.request_finished(request)
+
+
+def process_request(path, request=None):
+    """ Returns the encoded JSON reply, an iterator of encoded JSON pieces
+        for a streamed reply or None for a 404 reply """
+    global family_request_order
+    global log
+    global generations_created
+    global person_replies
+    global family_replies
+
+    if 'start' in path:
+        family_request_order = []
+        person_replies = {}
+        family_replies = {}
+        parts = path.split('/')
+        if len(parts) < 3:
             return None
 
+        try:
+            generations = int(parts[-1])
+        except:
+            generations = MAX_GENERATIONS
+
+        output = f'Creating family tree with {generations} generations...'
+        print(output)
+        log.write(output)
 
-    def get_family(self, id):
-        global families
-        if id in families:
-            return families[id].get_dict()
+        generations_created = generations
+        if LAZY_TREE:
+            build_lazy_tree(generations)
+            # the same seed and generations always give the same tree
+            tree_version = f'lazy-{LAZY_SEED:x}-{PRIME}-{ID}-{generations}'
         else:
+            if COMPACT_TREE:
+                build_compact_tree(generations)
+            else:
+                build_tree(generations)
+            tree_version = f'{random.getrandbits(64):016x}'
+
+        metrics.reset(request)
+
+        # clients use "tree" to know when saved replies are out of date
+        json_data = json.dumps({"status": "OK", "tree": tree_version}).encode('utf8')
+
+    elif 'end' in path:
+        print('#' * 80)
+        log.write('#' * 80)
+
+        person_count = count_people()
+        print(f'Total number of people  : {"unknown" if person_count is None else person_count}')
+        print(f'Total number of families: {len(families)}')
+        print(f'Number of generations   : {generations_created}')
+        log.write(f'Total number of people  : {"unknown" if person_count is None else person_count}')
+        log.write(f'Total number of families: {len(families)}')
+        log.write(f'Number of generations   : {generations_created}')
+
+
+        print('Families were requested in this order:')
+        log.write('Families were requested in this order:')
+        
+        output = str(family_request_order)[1:-1]
+        print(output)
+        log.write(output)
+
+        totals = metrics.totals()
+        print(f'Total number of API calls: {totals["api"]}')
+        log.write(f'Total number of API calls: {totals["api"]}')
+
+        print(f'Final thread count (max count): {totals["threads"]}')
+        log.write(f'Final thread count (max count): {totals["threads"]}')
+
+        data = {"status": "OK", "people": person_count, "families": len(families), "api": totals["api"], "threads": totals["threads"]}
+        json_data = json.dumps(data).encode('utf8')
+
+        print('#' * 80)
+        log.write('#' * 80)
+
+    elif path.startswith('/metrics'):
+        json_data = json.dumps(dict(status="OK", **metrics.totals())).encode('utf8')
+
+    elif path.startswith('/pedigree'):
+        # /pedigree/{family_id}/{depth} is streamed, so it is returned as
+        # an iterator of JSON pieces instead of one string
+        parts = path.split('/')
+        try:
+            id = decode(int(parts[2]))
+            depth = int(parts[3])
+        except:
             return None
- 
-    def do_GET(self):
-        global thread_count
-        global lock
-        global max_thread_count
-        global call_count
-        global family_request_order
-        global log
-        global generations_created
-
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(f'Request: {self.path}')
-
-        log.write(f'Request: {self.path}')
-
-        if SLEEP > 0:
-            time.sleep(SLEEP)
-
-        if 'start' in self.path:
-            family_request_order = []
-            parts = self.path.split('/')
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        if id not in families:
+            return None
 
-            try:
-                generations = int(parts[-1])
-            except:
-                generations = MAX_GENERATIONS
-
-            output = f'Creating family tree with {generations} generations...'
-            print(output)
-            log.write(output)
-
-            generations_created = generations
-            build_tree(generations)
-
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
-
-            json_data = '{"status":"OK"}'
-
-                    
-        elif 'end' in self.path:
-            print('#' * 80)
-            log.write('#' * 80)
-
-            print(f'Total number of people  : {len(people)}')
-            print(f'Total number of families: {len(families)}')
-            print(f'Number of generations   : {generations_created}')
-            log.write(f'Total number of people  : {len(people)}')
-            log.write(f'Total number of families: {len(families)}')
-            log.write(f'Number of generations   : {generations_created}')
-
-
-            print('Families were requested in this order:')
-            log.write('Families were requested in this order:')
-            
-            output = str(family_request_order)[1:-1]
-            print(output)
-            log.write(output)
-
-            print(f'Total number of API calls: {call_count}')
-            log.write(f'Total number of API calls: {call_count}')
-
-            print(f'Final thread count (max count): {max_thread_count}')
-            log.write(f'Final thread count (max count): {max_thread_count}')
-
-            data_str = '{' + \
-                       f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-            print('#' * 80)
-            log.write('#' * 80)
-
-        elif 'person' in self.path or 'family' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
-
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        if not QUIET:
+            print(f'Sending: pedigree of family {encode(id)}, depth {depth}')
+        log.write(f'Sending: pedigree of family {encode(id)}, depth {depth}')
+        return stream_pedigree(id, depth)
+
+    elif path.startswith('/persons') or path.startswith('/families'):
+        # batch request: /persons?ids=a,b,c or /families?ids=a,b,c
+        # replies with a list of records in the same order as the ids
+        query = urllib.parse.urlsplit(path).query
+        codes = urllib.parse.parse_qs(query).get('ids', [''])[0].split(',')
 
+        replies = []
+        for code in codes:
             try:
-                id = decode(int(parts[-1]))
+                id = decode(int(code))
             except:
                 id = None
 
             if id == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
-
-            if 'person' in self.path:
-                data = self.get_person(id)
+                reply = None
+            elif path.startswith('/persons'):
+                reply = get_person_reply(id)
             else:
-                data = self.get_family(id)
+                reply = get_family_reply(id)
                 family_request_order.append(id)
 
-            if data != None:
-                json_data = json.dumps(data)
-            else:
-                json_data = None
+            replies.append(b'null' if reply == None else reply)
+
+        json_data = b'[' + b', '.join(replies) + b']'
+
+    elif 'person' in path or 'family' in path:
+        parts = path.split('/')
+        # print('****************************')
+        # print(parts)
+
+        if len(parts) < 3:
+            return None
+
+        try:
+            id = decode(int(parts[-1]))
+        except:
+            id = None
+
+        if id == None:
+            return None
+
+        if 'person' in path:
+            json_data = get_person_reply(id)
         else:
-            start_id = 1 # random.randint(1, 100000)
-            data = {"start_family_id" : encode(start_id)}
-            json_data = json.dumps(data)
-
-        if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
+            json_data = get_family_reply(id)
+            family_request_order.append(id)
+    else:
+        start_id = 1 # random.randint(1, 100000)
+        data = {"start_family_id" : encode(start_id)}
+        json_data = json.dumps(data).encode('utf8')
+
+    if json_data != None:
+        if not QUIET:
+            print('Sending:', json_data.decode('utf8'))
+        log.write_reply('Sending: ', json_data)
+
+    return json_data
+
+
+# ----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if not QUIET:
+            super().log_message(format, *args)
+
+    def send_json(self, code, json_data):
+        # Content-Length is always sent so HTTP/1.1 clients can keep the
+        # connection open, even for a 404 without a body
+        body = b'' if json_data == None else json_data
+        self.send_response(code)
+        self.send_header("Content-type",  "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, pieces):
+        # chunked encoding keeps an HTTP/1.1 connection open, otherwise the
+        # end of the reply is marked by closing the connection
+        chunked = self.protocol_version == 'HTTP/1.1' and self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header("Content-type",  "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+            self.close_connection = True
+        self.end_headers()
 
-            self.send_response(200)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+        for piece in pieces:
+            if chunked:
+                self.wfile.write(f'{len(piece):X}\r\n'.encode('latin-1') + piece + b'\r\n')
+            else:
+                self.wfile.write(piece)
+
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        request = request_started(self.path)
+        try:
+            delay, error = latency.decide(request.route)
+            if delay > 0:
+                time.sleep(delay)
+
+            if error != None:
+                self.send_json(error, None)
+                return
 
-        with lock:
-            thread_count -= 1
+            json_data = process_request(self.path, request)
+
+            if json_data == None:
+                self.send_json(404, None)
+            elif isinstance(json_data, bytes):
+                self.send_json(200, json_data)
+            else:
+                self.send_stream(json_data)
+        finally:
+            request_finished(request)
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    daemon_threads = True
+
+
+# ----------------------------------------------------------------------------
+# asyncio server mode
+#
+# Every request is a coroutine instead of an OS thread, so the latency delay
+# does not hold a thread and one core can keep tens of thousands of requests
+# waiting at the same time.  The routes, the people/families dictionaries and
+# the request metrics are shared with the threaded server (in this mode the
+# thread count is the number of requests in progress).
+#
+# With keep-alive turned on, requests pipelined on one connection are
+# processed at the same time and the replies are written back in order.
+# ----------------------------------------------------------------------------
+ASYNC_BACKLOG = 4096
+PIPELINE_DEPTH = 64
+
+def http_reply(code, json_data, keep_alive):
+    body = b'' if json_data == None else json_data
+    status = f'{code} {http.HTTPStatus(code).phrase}'
+    version = 'HTTP/1.1' if KEEP_ALIVE else 'HTTP/1.0'
+    connection = 'keep-alive' if keep_alive else 'close'
+    header = f'{version} {status}\r\nContent-type: application/json\r\n' \
+             f'Content-Length: {len(body)}\r\nConnection: {connection}\r\n\r\n'
+    return header.encode('latin-1') + body
+
+
+def http_stream(pieces, keep_alive):
+    # keep_alive is only set for HTTP/1.1 clients, so chunked encoding can
+    # be used; otherwise the connection is closed after the reply
+    connection = 'keep-alive' if keep_alive else 'close'
+    header = f'{"HTTP/1.1" if KEEP_ALIVE else "HTTP/1.0"} 200 OK\r\nContent-type: application/json\r\n'
+    if keep_alive:
+        header += 'Transfer-Encoding: chunked\r\n'
+    yield (header + f'Connection: {connection}\r\n\r\n').encode('latin-1')
+
+    for piece in pieces:
+        if keep_alive:
+            yield f'{len(piece):X}\r\n'.encode('latin-1') + piece + b'\r\n'
+        else:
+            yield piece
+
+    if keep_alive:
+        yield b'0\r\n\r\n'
+
+
+async def read_async_request(reader):
+    """ Returns (method, path, keep_alive) or None when the client is done """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    parts = request_line.decode('latin-1').split()
+    version = parts[2] if len(parts) > 2 else 'HTTP/1.0'
+    connection = ''
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'connection':
+            connection = value.strip().lower()
+
+    keep_alive = KEEP_ALIVE and version == 'HTTP/1.1' and connection != 'close'
+
+    method = parts[0] if parts else ''
+    path = parts[1] if len(parts) > 1 else ''
+    return method, path, keep_alive
+
+
+async def async_reply(method, path, keep_alive):
+    if method != 'GET' or path == '':
+        return http_reply(404, None, keep_alive)
+
+    request = request_started(path)
+    try:
+        delay, error = latency.decide(request.route)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if error != None:
+            return http_reply(error, None, keep_alive)
+
+        json_data = process_request(path, request)
+        if json_data == None or isinstance(json_data, bytes):
+            return http_reply(404 if json_data == None else 200, json_data, keep_alive)
+        # a streamed reply is written by the sender while it is created
+        return http_stream(json_data, keep_alive)
+    finally:
+        request_finished(request)
+
+
+async def handle_async_connection(reader, writer):
+    replies = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+
+    async def send_replies():
+        # keep taking replies after a write error so the reader never blocks
+        broken = False
+        while True:
+            task = await replies.get()
+            if task == None:
+                break
+            reply = await task
+            if broken:
+                continue
+            try:
+                if isinstance(reply, bytes):
+                    writer.write(reply)
+                    await writer.drain()
+                else:
+                    for data in reply:
+                        writer.write(data)
+                        await writer.drain()
+            except ConnectionError:
+                broken = True
+
+    sender = asyncio.create_task(send_replies())
+    try:
+        while True:
+            request = await read_async_request(reader)
+            if request == None:
+                break
+            method, path, keep_alive = request
+            await replies.put(asyncio.create_task(async_reply(method, path, keep_alive)))
+            if not keep_alive:
+                break
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+
+    finally:
+        await replies.put(None)
+        await sender
+        writer.close()
+
+
+async def serve_async():
+    server = await asyncio.start_server(handle_async_connection, hostName, serverPort, backlog=ASYNC_BACKLOG)
+    async with server:
+        await server.serve_forever()
+
 
 if __name__ == '__main__':
     # random.seed(101)
@@ -454,7 +1556,64 @@ if __name__ == '__main__':
     # for id in families:
     #     print(families[id])
 
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
-    print('Starting server, use <Ctrl-C> or <Command-C> to stop')
-    server.serve_forever()
-
+    parser = argparse.ArgumentParser(description='Family Search server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve requests with asyncio instead of one thread per request')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use HTTP/1.1 persistent connections (and pipelining)')
+    parser.add_argument('--compact', action='store_true',
+                        help='build the tree in compact array columns (for 20+ generations)')
+    parser.add_argument('--lazy', action='store_true',
+                        help='make families and people when they are first requested')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for --lazy trees and the id encoding (same seed = same replies)')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't echo every request and reply to the terminal")
+    parser.add_argument('--log-flush', type=float, default=LOG_FLUSH_INTERVAL, metavar='SECONDS',
+                        help='seconds between flushes of server.log')
+    parser.add_argument('--latency', type=parse_latency, default=FixedLatency(SLEEP), metavar='MODEL',
+                        help='fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA (default fixed:SLEEP)')
+    parser.add_argument('--route-latency', type=parse_route_latency, action='append', default=[], metavar='ROUTE=MODEL',
+                        help='latency for one route, for example person=uniform:0.1,0.4')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, default=None, metavar='RATE[,BURST]',
+                        help='token bucket limit in requests a second, extra requests get a 429 reply')
+    parser.add_argument('--error-rate', type=parse_error_rate, default=0.0, metavar='P',
+                        help='part of the requests (0 to 1) that get a 503 reply')
+    parser.add_argument('--latency-seed', type=int, default=None, metavar='N',
+                        help='seed for the latency and error random numbers')
+    args = parser.parse_args()
+    if args.log_flush <= 0:
+        # the log thread waits this long for a line, 0 would make it spin
+        parser.error('--log-flush must be more than 0 seconds')
+
+    QUIET = args.quiet
+    log.flush_interval = args.log_flush
+
+    latency_seed = args.latency_seed if args.latency_seed != None else random.getrandbits(64)
+    latency = LatencyModel(args.latency, dict(args.route_latency), args.rate_limit,
+                           args.error_rate, latency_seed & MASK64)
+    COMPACT_TREE = args.compact
+    LAZY_TREE = args.lazy
+
+    if args.seed != None:
+        seeded = random.Random(args.seed)
+        PRIME = seeded.choice(primes)
+        ID = seeded.randint(10000, 10000000)
+        LAZY_SEED = args.seed & MASK64
+    else:
+        LAZY_SEED = random.getrandbits(64)
+
+    if args.keep_alive:
+        KEEP_ALIVE = True
+        Handler.protocol_version = 'HTTP/1.1'
+
+    if args.use_async:
+        print('Starting asyncio server, use <Ctrl-C> or <Command-C> to stop')
+        try:
+            asyncio.run(serve_async())
+        except KeyboardInterrupt:
+            pass
+    else:
+        server = ThreadingSimpleServer((hostName, serverPort), Handler)
+        print('Starting server, use <Ctrl-C> or <Command-C> to stop')
+        server.serve_forever()
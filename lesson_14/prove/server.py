@@ -9,6 +9,10 @@ Instructions:
 
 Open a terminal window and run this program
 
+Options:
+    --quiet       don't echo every request and reply to the terminal
+    --log-flush S seconds between flushes of server.log
+
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
@@ -26,7 +30,10 @@ import json
 import time
 import random
 import threading
+import queue
+import atexit
 import ast
+import argparse
 
 hostName = "127.0.0.1"
 serverPort = 8123
@@ -34,6 +41,13 @@ serverPort = 8123
 SLEEP = 0.25
 MAX_GENERATIONS = 6
 
+# Log file writer: seconds between flushes and most lines written at a time
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH = 1000
+
+# Don't echo every request and reply to the terminal (--quiet)
+QUIET = False
+
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
             5000008127, 5000008133, 5000008147, 5000008151, 5000008201, 5000008219, 5000008271, 5000008297, 5000008313, 5000008319,
@@ -115,22 +129,55 @@ def decode(code: int):
         return (code ^ PRIME) // ID
 
 class Log:
+    """ write() only puts the line on a queue.  A background thread writes the
+        lines to the file in batches and flushes it every flush_interval
+        seconds, so request threads never wait on the disk """
 
-    def __init__(self, filename):
+    def __init__(self, filename, flush_interval=LOG_FLUSH_INTERVAL):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.flush_interval = flush_interval
         self.file = open(filename, 'w')
+        self.lines = queue.SimpleQueue()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+        self.lines.put(line)
+
+    def _write_lines(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            batch = []
+            try:
+                batch.append(self.lines.get(timeout=self.flush_interval))
+                while len(batch) < LOG_BATCH:
+                    batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                pass
+
+            # None is put on the queue by close()
+            done = None in batch
+            lines = [line for line in batch if line is not None]
+            if lines:
+                self.file.write('\n'.join(lines))
+                self.file.write('\n')
+
+            if done or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
 
-    def __del__(self):
         self.file.close()
 
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.writer.join()
+
 # Global log object
 log = Log('server.log')
 
@@ -282,6 +329,10 @@ def build_tree(gens):
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    def log_message(self, format, *args):
+        if not QUIET:
+            super().log_message(format, *args)
+
     def get_person(self, id):
         global people
         if id in people:
@@ -311,11 +362,13 @@ class Handler(BaseHTTPRequestHandler):
             call_count += 1
             if thread_count > max_thread_count:
                 max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+            if not QUIET:
+                print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
             log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(f'Request: {self.path}')
+        if not QUIET:
+            print('- ' * 35)
+            print(f'Request: {self.path}')
 
         log.write(f'Request: {self.path}')
 
@@ -431,7 +484,8 @@ class Handler(BaseHTTPRequestHandler):
             self.send_header("Content-type",  "application/json")
             self.end_headers()
         else:
-            print('Sending:', json_data)
+            if not QUIET:
+                print('Sending:', json_data)
             log.write(f'Sending: {json_data}')
 
             self.send_response(200)
@@ -454,6 +508,19 @@ if __name__ == '__main__':
     # for id in families:
     #     print(families[id])
 
+    parser = argparse.ArgumentParser(description='Family Search server')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't echo every request and reply to the terminal")
+    parser.add_argument('--log-flush', type=float, default=LOG_FLUSH_INTERVAL, metavar='SECONDS',
+                        help='seconds between flushes of server.log')
+    args = parser.parse_args()
+    if args.log_flush <= 0:
+        # the log thread waits this long for a line, 0 would make it spin
+        parser.error('--log-flush must be more than 0 seconds')
+
+    QUIET = args.quiet
+    log.flush_interval = args.log_flush
+
     server = ThreadingSimpleServer((hostName, serverPort), Handler)
     print('Starting Family Search server, use <Ctrl-C> or <Command-C> to stop')
     print(f'URL = {hostName}:{serverPort}\n')